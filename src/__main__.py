@@ -1,5 +1,11 @@
 import api
 import uvicorn
+from os import getenv
 
 if __name__ == "__main__":
-    uvicorn.run("api:api", host="0.0.0.0", port=8080, reload=True)
\ No newline at end of file
+    # With more than one worker, logouts apply to all of them only with a
+    # shared revocation store (SESSION_STORE=postgres)
+    workers = int(getenv("API_WORKERS", "1"))
+    uvicorn.run(
+        "api:api", host="0.0.0.0", port=8080, reload=workers == 1, workers=workers
+    )
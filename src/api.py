@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
-from fastapi import FastAPI, Body, Depends, Header, BackgroundTasks
+from fastapi import FastAPI, Body, Depends, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import time
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
 import json
+from datetime import datetime
+from hashlib import sha1
 
 from modules.auth.model import (
     UserLoginSchema,
@@ -11,82 +17,100 @@ from modules.auth.model import (
     EventCreateSchema,
     EventResponseSchema,
     TicketCreateSchema,
-    TicketResponseSchema,
+    TicketBulkCreateSchema,
+    BulkMintSchema,
+    AllowlistImportSchema,
 )
 from modules.auth.handler import signJWT
-from modules.auth.bearer import JWTBearer
+from modules.auth.bearer import JWTBearer, Principal
 
 import logging  # Logging important events
 from dotenv import load_dotenv  # Load environment variables from .env
 from os import getenv  # Get environment variables
-from modules.db import DBManager  # Database manager
+from modules.db import DBManager, AsyncDBManager  # Database managers
 from modules import contracts  # Smart contracts
-from modules.auth.state import AuthPair
-from modules.nftimage.nftimage import NFTImage
+from modules.auth.state import create_authpair
+from modules.nftimage.nftimage import NFTImage, ImageTooLarge
 from modules.imagetools import ImageTools
+from modules.reconciler import MintReconciler
+from modules.minter import Minter
+from modules.imagepipeline import ImagePipeline
+from modules.jobqueue import JobQueue
+from modules.tasks import register_tasks
+from modules.cache import SWRCache
+from modules import metrics
+from modules.metrics import MetricsMiddleware
+from modules.logs import setup_logging
 
 
 # region Logging
 # Create a logger instance
 log = logging.getLogger("backend")
-# Create log formatter
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-
-# Сreate console logging handler and set its level
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(formatter)
-log.addHandler(ch)
 
 # region Docker check
 # Check if we are under Docker
-DOCKER_MODE = getenv("DOCKER_MODE")
-if getenv("DOCKER_MODE") == "true":
-    DOCKER_MODE = True
-    log.warning("Docker mode enabled")
-else:
-    log.warning("Docker mode disabled")
+DOCKER_MODE = getenv("DOCKER_MODE") == "true"
 
 # Load environment variables from .env file
 if not DOCKER_MODE:
     load_dotenv()
 # endregion
 
-# Create file logging handler and set its level
+# Records are queued, a listener thread formats (JSON) and writes them to
+# the console and a size-rotated file
 if DOCKER_MODE:
     logfile_path = r"/data/backend.log"
 else:
     logfile_path = r"backend.log"
-fh = logging.FileHandler(logfile_path)
-fh.setFormatter(formatter)
-log.addHandler(fh)
-
-# Set logging level
-logging_level_lower = getenv("LOGGING_LEVEL").lower()
-if logging_level_lower == "debug":
-    log.setLevel(logging.DEBUG)
-    log.critical("Log level set to debug")
-elif logging_level_lower == "info":
-    log.setLevel(logging.INFO)
-    log.critical("Log level set to info")
-elif logging_level_lower == "warning":
-    log.setLevel(logging.WARNING)
-    log.critical("Log level set to warning")
-elif logging_level_lower == "error":
-    log.setLevel(logging.ERROR)
-    log.critical("Log level set to error")
-elif logging_level_lower == "critical":
-    log.setLevel(logging.CRITICAL)
-    log.critical("Log level set to critical")
+log_listener = setup_logging(log, logfile_path, getenv("LOGGING_LEVEL", "info"))
+log.warning("Docker mode enabled" if DOCKER_MODE else "Docker mode disabled")
+log.critical(f"Log level set to {logging.getLevelName(log.level).lower()}")
 # endregion
 
 # region Images
 nftimage = NFTImage()
 itools = ImageTools(getenv("PICTSHARE_URL"))
+pipeline = ImagePipeline(log, itools)
+# Seconds /create/ticket waits for its job before answering with the job id
+TICKET_TIMEOUT = float(getenv("TICKET_TIMEOUT", "20"))
+# Bulk ticket creation: images processed at once, tickets per INSERT
+BULK_IMAGE_CONCURRENCY = int(getenv("BULK_IMAGE_CONCURRENCY", "8"))
+BULK_CHUNK_SIZE = int(getenv("BULK_CHUNK_SIZE", "200"))
 # endregion
 
 # region DB
-db = DBManager(log, itools)
+db = DBManager(log, itools)  # Creates the schema, used outside of requests
+adb = AsyncDBManager(log)  # Per-request sessions for the endpoints
+# endregion
+
+# region Mint reconciler
+reconciler = MintReconciler(log, adb)
+minter = Minter(log, adb, reconciler)
+# endregion
+
+# region Wallet NFTs
+# qn_fetchNFTs results per wallet: fresh for WALLET_CACHE_TTL seconds, then
+# served stale for WALLET_CACHE_STALE more while one request refreshes them
+wallet_nfts = SWRCache(
+    int(getenv("WALLET_CACHE_SIZE", "10000")),
+    ttl=float(getenv("WALLET_CACHE_TTL", "30")),
+    stale=float(getenv("WALLET_CACHE_STALE", "300")),
+)
+# A confirmed mint changes the recipient's holdings. The reconciler may run
+# in worker.py, the invalidation reaches this process through adb.listen()
+adb.on_invalidate["wallet"] = [wallet_nfts.invalidate]
+reconciler.on_success.append(lambda db_mint: adb.invalidate("wallet", db_mint.wallet))
+# endregion
+
+# region Jobs
+# Seconds /mint_nft/ waits for its job before answering with the job id
+MINT_TIMEOUT = float(getenv("MINT_TIMEOUT", "20"))
+# Durable background jobs, run by worker.py (and here with API_RUN_WORKER)
+job_queue = JobQueue(log, adb)
+register_tasks(job_queue, adb, pipeline, minter)
+# Whether this process also runs the mint reconciler and the job handlers.
+# Set it to false when separate workers are deployed
+API_RUN_WORKER = getenv("API_RUN_WORKER", "true") == "true"
 # endregion
 
 # region API
@@ -99,9 +123,35 @@ api.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+api.add_middleware(MetricsMiddleware)
+
+
+@api.on_event("startup")
+async def startup():
+    contracts.settings()  # Fails fast when QUIKNODE_URL is missing
+    adb.listen()
+    if API_RUN_WORKER:
+        reconciler.start()
+        job_queue.start()
+
+
+@api.on_event("shutdown")
+async def shutdown():
+    await job_queue.stop()
+    await reconciler.stop()
+    await pipeline.close()
+    await adb.close()
+    await contracts.close()
+    log_listener.stop()
+
+
+# Upper bound for the limit of paginated endpoints
+MAX_PAGE_SIZE = int(getenv("MAX_PAGE_SIZE", "500"))
 
 # region Auth state store
-authpair = AuthPair()
+# Revoked tokens, JWTBearer rejects tokens listed in it (logged out)
+authpair = create_authpair(adb)
+JWTBearer.store = authpair
 # endregion
 
 
@@ -114,30 +164,73 @@ def check_user(data: UserLoginSchema) -> bool:
         return False
 
 
-def get_token(token: str) -> str:
-    """Get token without Bearer"""
-    return token.split(" ")[1]
-
-
-# endregion
-
-# region BackgroundTask
-def update_nft_status(data: tuple):
-    internal_id = data[0]
-    nft_id = data[1]
-    collection_id = data[2]
-    response = contracts.check_minting_status(nft_id, collection_id)
-    log.info(response)
-    log.info(f'hash: {response["onChain"]["status"]}')
-    while response["onChain"]["status"] != "success":
-        # update nft
-        log.info(response["onChain"]["status"])
-        response = contracts.check_minting_status(nft_id, collection_id)
-        time.sleep(10)
-
-    db.update_mint(internal_id, response["onChain"]["mintHash"])
-    log.error("It is WORKING!!!")
-    # TODO: update
+def etag_response(request: Request, payload) -> Response:
+    """JSON response with an ETag, 304 when it matches If-None-Match"""
+    body = json.dumps(
+        jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")
+    ).encode()
+    etag = f'"{sha1(body).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def split_fields(fields: str | None) -> list[str] | None:
+    """Sparse field selection: "a,b" -> ["a", "b"]"""
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+async def bulk_create_tickets(bulk: TicketBulkCreateSchema):
+    """Yields one NDJSON line per ticket, then a summary line.
+    Images are processed concurrently (identical pictures share the work via
+    the image cache). Each chunk is inserted in its own short transaction
+    once its images are ready, so no connection is held while they are
+    processed; its lines are yielded after the commit"""
+    semaphore = asyncio.Semaphore(BULK_IMAGE_CONCURRENCY)
+
+    async def images(ticket):
+        async with semaphore:
+            return await pipeline.process(ticket.image)
+
+    tasks = [asyncio.ensure_future(images(ticket)) for ticket in bulk.tickets]
+    created = failed = 0
+    try:
+        for offset in range(0, len(tasks), BULK_CHUNK_SIZE):
+            chunk = tasks[offset : offset + BULK_CHUNK_SIZE]
+            results = await asyncio.gather(*chunk, return_exceptions=True)
+            rows, lines = [], []
+            for index, result in enumerate(results, start=offset):
+                # CancelledError is a BaseException
+                if isinstance(result, BaseException):
+                    failed += 1
+                    lines.append({"index": index, "error": repr(result)})
+                    continue
+                mint_img, blur_img = result
+                rows.append(
+                    adb.nft_values(bulk.tickets[index], bulk.eventId, mint_img, blur_img)
+                )
+                lines.append({"index": index, "blurredImage": blur_img})
+            if rows:
+                async with adb.sessionmaker() as session:
+                    async with session.begin():
+                        ids = iter(await adb.insert_nfts(session, rows))
+                adb.invalidate_nfts(bulk.eventId)
+            for line in lines:
+                if "error" not in line:
+                    line["id"] = next(ids)
+                    created += 1
+                yield json.dumps(line) + "\n"
+        yield json.dumps({"created": created, "failed": failed}) + "\n"
+    except Exception as e:
+        log.error(f"Bulk ticket creation for event {bulk.eventId} failed: {e!r}")
+        yield json.dumps({"error": repr(e), "created": created, "failed": failed}) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 # endregion
@@ -148,23 +241,42 @@ async def root():
     return {"message": "I love NFTs!"}
 
 
+@api.get("/metrics", tags=["root"], include_in_schema=False)
+async def get_metrics():
+    """Prometheus text exposition"""
+    body, content_type = metrics.render()
+    return Response(body, headers={"Content-Type": content_type})
+
+
 @api.post("/auth/login", tags=["auth"])
-async def login(user: UserLoginSchema = Body(...)):
-    db.auth(user.vk_id, user.wallet_public_key, user.first_name, user.last_name)
-    token = signJWT(user.vk_id)
-    # Store the token in authpair
-    authpair.post(token["access_token"], user.vk_id)
-    return token
+async def login(
+    user: UserLoginSchema = Body(...), session: AsyncSession = Depends(adb.session)
+):
+    await adb.auth(
+        session, user.vk_id, user.wallet_public_key, user.first_name, user.last_name
+    )
+    return signJWT(user.vk_id)
 
 
 @api.post("/auth/nwlogin", tags=["auth"])
-async def nowallet_login(user: UserSimpleLoginSchema = Body(...)):
-    if not db.auth(user.vk_id, None, None, None):
+async def nowallet_login(
+    user: UserSimpleLoginSchema = Body(...),
+    session: AsyncSession = Depends(adb.session),
+):
+    if not await adb.auth(session, user.vk_id, None, None, None):
         return {"message": "User not found"}
-    token = signJWT(user.vk_id)
-    # Store the token in authpair
-    authpair.post(token["access_token"], user.vk_id)
-    return token
+    return signJWT(user.vk_id)
+
+
+@api.post("/auth/logout", tags=["auth"])
+async def logout(
+    principal: Principal = Depends(JWTBearer()),
+    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
+):
+    """Revokes the access token. Other API workers may accept it for up to
+    JWT_CACHE_TTL more seconds"""
+    await JWTBearer.revoke(credentials.credentials, principal)
+    return {"message": "Logged out"}
 
 
 # region Protected
@@ -174,55 +286,74 @@ async def nowallet_login(user: UserSimpleLoginSchema = Body(...)):
     "/mint_nft/",
     dependencies=[Depends(JWTBearer())],
 )
-async def mint_nft(
-    vk_id: int,
-    nft_id: int,
-    background_tasks: BackgroundTasks,
-    authorization: str = Header(None),
+async def mint_nft(vk_id: int, nft_id: int):
+    """Mints through a durable job, waited for up to MINT_TIMEOUT seconds;
+    202 with the job id for /get/job past that"""
+    job_id = await job_queue.enqueue("mint", {"nft_id": nft_id, "vk_id": vk_id})
+    job = await job_queue.wait(job_id, MINT_TIMEOUT)
+    if job is None:
+        return JSONResponse({"job_id": job_id}, status_code=202)
+    if job["status"] == "failed":
+        # ValueError: unknown NFT
+        status_code = 404 if job["error"].startswith("ValueError") else 500
+        raise HTTPException(status_code=status_code, detail=job["error"])
+    result = job["result"]
+    log.info("Mint of NFT %s to %s: %s", nft_id, vk_id, result["status"])
+    if result["status"] == "pending":
+        return {"status": "ok"}
+    return result
+
+
+@api.post("/mint_nft/bulk", dependencies=[Depends(JWTBearer())], tags=["nft", "admin"])
+async def bulk_mint_nft(mint: BulkMintSchema):
+    """Airdrop an NFT to `recipients` (VK ids, the event allowlist by default).
+    Responds with the id of a durable job; /get/job reports progress and
+    per-recipient results"""
+    job_id = await job_queue.enqueue("bulk_mint", mint.dict())
+    return JSONResponse({"job_id": job_id}, status_code=202)
+
+
+@api.get("/get/nfts", tags=["user", "nft"])
+async def get_nfts(
+    principal: Principal = Depends(JWTBearer()),
+    session: AsyncSession = Depends(adb.session),
+    offset: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1, le=MAX_PAGE_SIZE),
 ):
-    token = get_token(authorization)
-    log.info(authpair.get(token))
-    wallet_addr = db.get_user(vk_id).wallet_addr
-    log.error(wallet_addr)
-    db_nft = db.get_nft(nft_id)
-    log.warning(db_nft.mintImage)
-    db_event = db.get_event(db_nft.eventId)
-    response = await contracts.mint_nft(
-        db_event["collection_id"],
-        db_nft.title,
-        db_nft.description,
-        db_nft.mintImage,
+    """NFTs owned by the user's wallet. `offset`/`limit` page through `assets`"""
+    wallet_addr = await adb.get_user_wallet(session, principal.user_id)
+    if not wallet_addr:
+        raise HTTPException(status_code=404, detail="User has no wallet")
+    result = await wallet_nfts.get(
         wallet_addr,
-        json.loads(db_nft.properties),
+        lambda: contracts.get_all_nfts(wallet_addr),
+        cacheable=lambda result: "error" not in result,
     )
-    log.info(response)
-    nft_hash = response["id"]
-
-    background_tasks.add_task(
-        update_nft_status, (nft_id, nft_hash, db_event["collection_id"])
-    )
-    return {"status": "ok"}
-
-
-@api.get("/get/nfts", dependencies=[Depends(JWTBearer())], tags=["user", "nft"])
-async def get_nfts(authorization: str = Header(None)):
-    token = get_token(authorization)
-    wallet_addr = db.get_user_wallet(authpair.get(token))
-    return await contracts.get_all_nfts(wallet_addr)
-
-
-@api.post("/create/event", dependencies=[Depends(JWTBearer())], tags=["event", "admin"])
-async def create_event(event: EventCreateSchema, authorization: str = Header(None)):
-    token = get_token(authorization)
-    user_id = authpair.get(token)
+    if limit is None or "error" in result:
+        return result
+    assets = result.get("assets", [])
+    return {
+        **result,
+        "assets": assets[offset : offset + limit],
+        "offset": offset,
+        "limit": limit,
+        "total": len(assets),
+    }
+
+
+@api.post("/create/event", tags=["event", "admin"])
+async def create_event(
+    event: EventCreateSchema,
+    principal: Principal = Depends(JWTBearer()),
+    session: AsyncSession = Depends(adb.session),
+):
+    user_id = principal.user_id
     result = await contracts.create_collection(
         event.title, event.description, event.image
     )
-    log.warning(result)
+    log.info("cm_createCollection for %r: %s", event.title, result)
     collection_id = str(result["id"])
 
-    # wallet_addr = db.get_user_wallet(authpair.get(token))
-    # wallet_addr = db.get_user_wallet(authpair.get(token))
     # image_url = event.image#image.upload(event.image)
     # result = await contracts.create_collection(
     #     event.title, event.description, image_url
@@ -232,7 +363,7 @@ async def create_event(event: EventCreateSchema, authorization: str = Header(Non
     # Write event to DB
     #! What do we have in result?
 
-    db_event = db.create_event(event, user_id, collection_id)
+    db_event = await adb.create_event(session, event, user_id, collection_id)
 
     return {"eventId": db_event.id}  # EventResponseSchema.from_orm(db_event)
 
@@ -240,42 +371,182 @@ async def create_event(event: EventCreateSchema, authorization: str = Header(Non
 @api.post(
     "/create/ticket", dependencies=[Depends(JWTBearer())], tags=["event", "admin"]
 )
-async def create_nft(ticket: TicketCreateSchema, authorization: str = Header(None)):
-    token = get_token(authorization)
+async def create_nft(
+    ticket: TicketCreateSchema,
+    background: bool = False,
+):
+    """Creates a ticket through a durable job, run by the workers. The
+    response waits for it up to TICKET_TIMEOUT seconds, and is 202 with the
+    job id for /get/job past that, or right away with background=true"""
+    job_id = await job_queue.enqueue("create_ticket", ticket.dict())
+    job = None if background else await job_queue.wait(job_id, TICKET_TIMEOUT)
+    if job is None:
+        return JSONResponse({"job_id": job_id}, status_code=202)
+    if job["status"] == "failed":
+        too_large = job["error"].startswith(ImageTooLarge.__name__)
+        raise HTTPException(status_code=413 if too_large else 500, detail=job["error"])
+    return job["result"]
 
-    tk = db.create_nft(ticket)
 
-    return TicketResponseSchema.from_orm(tk)  # EventResponseSchema.from_orm(db_event)
+@api.post(
+    "/create/tickets", dependencies=[Depends(JWTBearer())], tags=["event", "admin"]
+)
+async def create_nfts(tickets: TicketBulkCreateSchema):
+    """Creates many tickets of one event. Streams NDJSON: one line per ticket
+    ({"index", "id", "blurredImage"} or {"index", "error"}), then a summary
+    line. Tickets are stored chunk by chunk: every line with an id was
+    committed, a summary with an "error" means the rest were not stored"""
+    return StreamingResponse(
+        bulk_create_tickets(tickets), media_type="application/x-ndjson"
+    )
+
+
+@api.get("/get/job", dependencies=[Depends(JWTBearer())], tags=["jobs"])
+async def get_job(job_id: str, session: AsyncSession = Depends(adb.session)):
+    """Status of a durable job: queued, running, done or failed"""
+    job = await adb.get_job(session, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@api.get("/get/jobs", dependencies=[Depends(JWTBearer())], tags=["jobs"])
+async def get_jobs(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    type: str | None = None,
+    status: str | None = Query(None, regex="^(queued|running|done|failed)$"),
+    session: AsyncSession = Depends(adb.session),
+):
+    """Paginated durable jobs, oldest first"""
+    try:
+        return await adb.get_jobs(session, limit, cursor, type, status)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @api.get("/get/events", dependencies=[Depends(JWTBearer())], tags=["event"])
-async def get_events():
-    return db.get_events()
+async def get_events(
+    request: Request,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    fields: str | None = None,
+    owner_id: int | None = None,
+    date_from: datetime | None = None,
+    date_to: datetime | None = None,
+    upcoming: bool = False,
+    order: str = Query("id", regex="^(id|datetime)$"),
+    session: AsyncSession = Depends(adb.session),
+):
+    """Paginated: pass next_cursor back as cursor. fields is a comma
+    separated subset of the event keys"""
+    try:
+        events = await adb.get_events(
+            session,
+            limit,
+            cursor,
+            split_fields(fields),
+            owner_id,
+            date_from,
+            date_to,
+            upcoming,
+            order,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return etag_response(request, events)
 
 
 @api.get("/get/event", dependencies=[Depends(JWTBearer())], tags=["event"])
-async def get_event_by_id(event_id: int):
-    return db.get_event(event_id)
+async def get_event_by_id(
+    request: Request, event_id: int, session: AsyncSession = Depends(adb.session)
+):
+    event = await adb.get_event(session, event_id)
+    if event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return etag_response(request, event)
+
+
+@api.get("/get/event/nfts", dependencies=[Depends(JWTBearer())], tags=["event"])
+async def get_event_nft(
+    request: Request,
+    event_id: int,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    fields: str | None = None,
+    session: AsyncSession = Depends(adb.session),
+):
+    """Paginated, items are TicketResponseSchema (or the selected fields)"""
+    try:
+        nfts = await adb.get_nfts(session, event_id, limit, cursor, split_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return etag_response(request, nfts)
+
+
+@api.get("/get/event/allowlist", dependencies=[Depends(JWTBearer())], tags=["event"])
+async def get_event_allowlist(
+    event_id: int,
+    limit: int = Query(500, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    session: AsyncSession = Depends(adb.session),
+):
+    """Paginated VK ids, in ascending order"""
+    try:
+        allowlist = await adb.get_event_allowlist(session, event_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "event_id": event_id,
+        "allowlist": [item["vk_id"] for item in allowlist["items"]],
+        "next_cursor": allowlist["next_cursor"],
+    }
 
 
 @api.get(
-    "/get/event/nfts",
-    dependencies=[Depends(JWTBearer())],
-    tags=["event"],
-    response_model=list[TicketResponseSchema],
+    "/get/event/allowlist/check", dependencies=[Depends(JWTBearer())], tags=["event"]
 )
-async def get_event_nft(event_id: int):
-    return db.get_nfts(event_id)
+async def check_event_allowlist(
+    event_id: int, vk_id: int, session: AsyncSession = Depends(adb.session)
+):
+    return {
+        "event_id": event_id,
+        "vk_id": vk_id,
+        "allowed": await adb.is_allowed(session, event_id, vk_id),
+    }
 
 
-@api.get("/get/event/allowlist", dependencies=[Depends(JWTBearer())], tags=["event"])
-async def get_event_allowlist(event_id: int):
-    return {"event_id": event_id, "allowlist": db.get_event_allowlist(event_id)}
+@api.post(
+    "/create/event/allowlist",
+    dependencies=[Depends(JWTBearer())],
+    tags=["event", "admin"],
+)
+async def import_event_allowlist(
+    allowlist: AllowlistImportSchema, session: AsyncSession = Depends(adb.session)
+):
+    """Adds VK ids to an event allowlist (bulk COPY), already listed ones
+    are ignored"""
+    if await adb.get_event(session, allowlist.eventId) is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    added = await asyncio.to_thread(
+        db.import_allowlist, allowlist.eventId, allowlist.vk_ids
+    )
+    adb.invalidate_allowlist(allowlist.eventId)
+    return {"event_id": allowlist.eventId, "added": added}
 
 
 @api.get("/get/users", dependencies=[Depends(JWTBearer())], tags=["user"])
-async def get_users():
-    return db.get_users()
+async def get_users(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    fields: str | None = None,
+    session: AsyncSession = Depends(adb.session),
+):
+    """Paginated list of {"vk_id", "wallet_public_key"}"""
+    try:
+        return await adb.get_users(session, limit, cursor, split_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 # endregion
@@ -283,8 +554,8 @@ async def get_users():
 
 # region Tests
 @api.get("/test/get_users", tags=["tests"])
-async def get_users_test():
-    return db.get_users_test()
+async def get_users_test(session: AsyncSession = Depends(adb.session)):
+    return await adb.get_users_test(session)
 
 
 # endregion
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import time
+from statistics import median
+
+import httpx
+
+
+def percentile(values: list[float], q: float) -> float:
+    """q-th percentile (0-100) of a list, nearest rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    """Throughput and latency percentiles (milliseconds) of one run"""
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round((len(latencies) + errors) / elapsed, 2) if elapsed else 0,
+        "p50_ms": round(median(latencies) * 1000, 2) if latencies else 0,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0) * 1000, 2),
+    }
+
+
+async def run_load(request, concurrency: int, total: int, base_url: str) -> dict:
+    """Call `await request(client, i)` `total` times from `concurrency`
+    workers sharing one keep-alive client. A request counts as an error
+    when it raises or returns a response with a 4xx/5xx status"""
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    response = await request(client, i)
+                    failed = response is not None and response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                if failed:
+                    errors += 1
+                else:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, errors, elapsed)
+
+
+def parse_levels(levels: str) -> list[int]:
+    """"1,10,50" -> [1, 10, 50]"""
+    return [int(level) for level in levels.split(",") if level.strip()]
+
+
+def save(results: dict, path: str | None) -> None:
+    """Print results and write them as JSON so runs can be compared"""
+    text = json.dumps(results, indent=2)
+    print(text)
+    if path:
+        with open(path, "w") as f:
+            f.write(text + "\n")
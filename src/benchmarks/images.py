@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""NFTImage microbenchmarks: decode, every transform operation and the
+encoders at typical ticket image sizes, plus the whole render_ticket chain.
+
+Run from src/ (fonts and assets are loaded relative to it):
+    python -m benchmarks.images --sizes 512,1024,2048 --repeat 20
+"""
+import argparse
+import time
+from statistics import median
+
+from benchmarks.common import parse_levels, percentile, save
+from benchmarks.stubs import sample_image
+from modules.imagepipeline import render_ticket
+from modules.nftimage.nftimage import NFTImage
+
+# Encoder settings come from IMAGE_COMPRESS_LEVEL / IMAGE_QUALITY
+ENCODERS = ["PNG", "JPEG", "WEBP"]
+
+
+def measure(func, repeat: int) -> dict:
+    """p50/p99 of `repeat` calls of func(), in milliseconds"""
+    func()  # Warm up caches (fonts, watermark overlays, worker state)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {
+        "repeat": repeat,
+        "p50_ms": round(median(timings) * 1000, 2),
+        "p99_ms": round(percentile(timings, 99) * 1000, 2),
+    }
+
+
+def bench_size(nftimage: NFTImage, size: int, repeat: int) -> dict:
+    source = sample_image(size)
+    decoded = nftimage.decode(source).convert("RGBA")
+    results = {
+        "source_bytes": len(source),
+        "decode": measure(lambda: nftimage.decode(source).load(), repeat),
+    }
+    for name in nftimage.operations:
+        results[name] = measure(lambda: nftimage.apply(decoded, [name]), repeat)
+    for format in ENCODERS:
+        image = decoded if format != "JPEG" else decoded.convert("RGB")
+        results[f"encode_{format.lower()}"] = measure(
+            lambda: nftimage.encode(image, format), repeat
+        )
+    results["render_ticket"] = measure(lambda: render_ticket(source), repeat)
+    return results
+
+
+def run(sizes: list[int], repeat: int) -> dict:
+    nftimage = NFTImage()
+    return {str(size): bench_size(nftimage, size, repeat) for size in sizes}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="512,1024,2048")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", default=None, help="JSON results file")
+    args = parser.parse_args()
+    save(
+        {
+            "benchmark": "images",
+            "started": time.time(),
+            "images": run(parse_levels(args.sizes), args.repeat),
+        },
+        args.output,
+    )
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Login throughput under concurrent clients.
+
+Run against a started API (and its database):
+    python -m benchmarks.login --url http://localhost:8080 --concurrency 1,10,50
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.common import parse_levels, run_load, save
+
+
+def login_request(users: int):
+    """/auth/login for random VK ids out of `users`, so new users and
+    repeated logins of existing ones (the upsert conflict path) are mixed"""
+
+    async def request(client, i):
+        vk_id = 900_000_000 + random.randrange(users)
+        return await client.post(
+            "/auth/login",
+            json={
+                "first_name": "Bench",
+                "last_name": f"User{vk_id}",
+                "vk_id": vk_id,
+                "wallet_public_key": f"BENCH{vk_id}",
+            },
+        )
+
+    return request
+
+
+async def main(args) -> dict:
+    results = {"benchmark": "login", "started": time.time(), "runs": []}
+    for concurrency in parse_levels(args.concurrency):
+        stats = await run_load(
+            login_request(args.users), concurrency, args.requests, args.url
+        )
+        results["runs"].append({"concurrency": concurrency, **stats})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--concurrency", default="1,10,50")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--output", default=None, help="JSON results file")
+    args = parser.parse_args()
+    save(asyncio.run(main(args)), args.output)
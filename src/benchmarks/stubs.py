@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Offline stand-ins for the external services.
+
+Quiknode: a JSON-RPC endpoint (single and batch calls) answering
+cm_createCollection, cm_mintNFT, cm_getNFTMintStatus and qn_fetchNFTs.
+Pictshare: POST /api/upload.php returns a link named after the sha1 of the
+upload (the real service also deduplicates by content), GET /source.jpg serves a
+ticket source image. Any query string is appended to the image bytes
+(decoders ignore trailing data), so /source.jpg?1 and /source.jpg?2 are
+different images to the content-addressed image cache.
+
+    python -m benchmarks.stubs --latency 0.05
+"""
+import argparse
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def sample_image(size: int = 1024, format: str = "JPEG") -> bytes:
+    """Photo-like test image: a gradient with noise, so blur and the
+    encoders do representative work"""
+    gradient = Image.linear_gradient("L").resize((size, size))
+    noise = Image.effect_noise((size, size), 64)
+    image = Image.merge("RGB", (gradient, noise, gradient.rotate(90)))
+    buffer = io.BytesIO()
+    image.save(buffer, format)
+    return buffer.getvalue()
+
+
+def link(image: bytes) -> str:
+    """Link the Pictshare stub answers for an upload, content-addressed"""
+    return f"http://pictshare.local/{sha1(image).hexdigest()}.png"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real services
+    latency = 0.0  # Seconds added to every response
+    # Per server (see serve()): statuses answered, in order, to the next
+    # POSTs instead of the real response, and the number of POSTs seen
+    failures: list[int] = []
+    calls = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _fail(self) -> bool:
+        """Count the POST and answer the next queued failure, if any"""
+        type(self).calls += 1
+        if not self.failures:
+            return False
+        self._body()
+        self._send(b"", "text/plain", self.failures.pop(0))
+        return True
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _send(self, body: bytes, content_type: str, status: int = 200) -> None:
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, value) -> None:
+        self._send(json.dumps(value).encode(), "application/json")
+
+
+class QuiknodeHandler(StubHandler):
+    reverse_batches = False  # Answer batches in reverse, as JSON-RPC allows
+
+    def do_POST(self):
+        if self._fail():
+            return
+        payload = json.loads(self._body())
+        if isinstance(payload, list):
+            answers = [self._answer(call) for call in payload]
+            self._json(answers[::-1] if self.reverse_batches else answers)
+        else:
+            self._json(self._answer(payload))
+
+    @staticmethod
+    def _answer(call: dict) -> dict:
+        method = call.get("method")
+        if method in ("cm_createCollection", "cm_mintNFT"):
+            result = {"id": str(uuid.uuid4())}
+        elif method == "cm_getNFTMintStatus":
+            result = {"onChain": {"status": "success", "mintHash": uuid.uuid4().hex}}
+        elif method == "qn_fetchNFTs":
+            result = {"owner": call["params"][0], "assets": [], "totalItems": 0}
+        else:
+            return {
+                "jsonrpc": "2.0",
+                "id": call.get("id"),
+                "error": {"code": -32601, "message": "Method not found"},
+            }
+        return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+
+class PictshareHandler(StubHandler):
+    source = b""  # Served by GET, see serve()
+
+    def do_POST(self):
+        if self._fail():
+            return
+        self._json({"status": "ok", "url": link(self._file())})
+
+    def _file(self) -> bytes:
+        """Content of the uploaded multipart file"""
+        content_type = self.headers.get("Content-Type", "").encode()
+        message = BytesParser().parsebytes(
+            b"Content-Type: " + content_type + b"\r\n\r\n" + self._body()
+        )
+        for part in message.walk():
+            if part.get_filename() is not None:
+                return part.get_payload(decode=True)
+        return b""
+
+    def do_GET(self):
+        _, _, query = self.path.partition("?")
+        self._send(self.source + query.encode(), "image/jpeg")
+
+
+def serve(handler: type, latency: float = 0.0, **attributes) -> ThreadingHTTPServer:
+    """Start `handler` on a free local port in a daemon thread"""
+    handler = type(
+        handler.__name__,
+        (handler,),
+        {"latency": latency, "failures": [], "calls": 0, **attributes},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start(latency: float = 0.0, image_size: int = 1024) -> dict:
+    """Both stubs, returns their servers and the URLs to configure the API with"""
+    quiknode = serve(QuiknodeHandler, latency)
+    pictshare = serve(PictshareHandler, latency, source=sample_image(image_size))
+    pictshare_url = f"http://127.0.0.1:{pictshare.server_port}/"
+    return {
+        "servers": [quiknode, pictshare],
+        "QUIKNODE_URL": f"http://127.0.0.1:{quiknode.server_port}/",
+        "PICTSHARE_URL": pictshare_url,
+        "source_image": pictshare_url + "source.jpg",
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    stubs = start(args.latency)
+    for key in ("QUIKNODE_URL", "PICTSHARE_URL", "source_image"):
+        print(f"{key}={stubs[key]}")
+    threading.Event().wait()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Offline benchmark suite: starts stub Quiknode and Pictshare servers and
+the API (uvicorn) wired to them, then measures /auth/login, /get/events,
+/create/ticket and /mint_nft/ at several concurrency levels, and the
+NFTImage microbenchmarks.
+
+Needs a local Postgres: PG_USER, PG_PASS, PG_HOST, PG_PORT and PG_DB are
+taken from the environment (or .env). Use a scratch database, the suite
+creates users, events and tickets. Run from src/:
+    python -m benchmarks.suite --concurrency 1,10,50 --output results.json
+
+MINT_RATE defaults to 1000 here so the cm_mintNFT rate limit does not cap
+the measurement; any setting in the environment wins.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+from dotenv import load_dotenv
+
+from benchmarks import images, stubs
+from benchmarks.common import parse_levels, run_load, save
+from benchmarks.login import login_request
+
+# VK ids of the users created for /mint_nft/ recipients
+MINT_USER_BASE = 910_000_000
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_api(port: int, workers: int, stub_env: dict) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "QUIKNODE_URL": stub_env["QUIKNODE_URL"],
+        "PICTSHARE_URL": stub_env["PICTSHARE_URL"],
+        "LOG_FORMAT": "text",
+    }
+    for key, value in {
+        "JWT_SECRET": "benchmark",
+        "JWT_ALGORITHM": "HS256",
+        "LOGGING_LEVEL": "warning",
+        "MINT_RATE": "1000",
+    }.items():
+        env.setdefault(key, value)
+    if workers > 1:
+        env.setdefault("SESSION_STORE", "postgres")
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "api:api",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+
+
+async def wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("The API exited during startup")
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError("The API did not start in time")
+
+
+# region Fixtures
+async def login(client: httpx.AsyncClient, vk_id: int) -> str:
+    response = await client.post(
+        "/auth/login",
+        json={
+            "first_name": "Bench",
+            "last_name": f"User{vk_id}",
+            "vk_id": vk_id,
+            "wallet_public_key": f"BENCH{vk_id}",
+        },
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def create_event(client: httpx.AsyncClient, headers: dict, vk_id: int) -> int:
+    response = await client.post(
+        "/create/event",
+        headers=headers,
+        json={
+            "title": "Benchmark",
+            "description": "Benchmark event",
+            "place": "Localhost",
+            "ownerId": str(vk_id),
+            "datetime": datetime.utcnow().isoformat(),
+            "image": "http://pictshare.local/event.png",
+        },
+    )
+    response.raise_for_status()
+    return response.json()["eventId"]
+
+
+def ticket(event_id: int, image: str) -> dict:
+    return {
+        "name": "Benchmark ticket",
+        "description": "Benchmark ticket",
+        "image": image,
+        "keys": {"type": "bench"},
+        "eventId": event_id,
+    }
+
+
+async def create_ticket(client, headers: dict, event_id: int, image: str) -> int:
+    response = await client.post(
+        "/create/ticket", headers=headers, json=ticket(event_id, image)
+    )
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+# endregion
+
+
+async def bench_endpoints(args, base_url: str, source_image: str) -> dict:
+    levels = parse_levels(args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        headers = {"Authorization": f"Bearer {await login(client, MINT_USER_BASE)}"}
+        event_id = await create_event(client, headers, MINT_USER_BASE)
+        # Recipients with wallets, one mint per (NFT, user) pair
+        for offset in range(0, args.requests, 50):
+            await asyncio.gather(
+                *(
+                    login(client, MINT_USER_BASE + i)
+                    for i in range(offset, min(offset + 50, args.requests))
+                )
+            )
+
+        async def get_events(client, i):
+            return await client.get("/get/events?limit=50", headers=headers)
+
+        def create_tickets(unique: str):
+            async def request(client, i):
+                # A distinct image per request, so every ticket runs the
+                # whole download / render / upload pipeline
+                image = f"{source_image}?{unique}-{i}"
+                return await client.post(
+                    "/create/ticket", headers=headers, json=ticket(event_id, image)
+                )
+
+            return request
+
+        def mint(nft_id: int):
+            async def request(client, i):
+                return await client.post(
+                    "/mint_nft/",
+                    headers=headers,
+                    params={"vk_id": MINT_USER_BASE + i, "nft_id": nft_id},
+                )
+
+            return request
+
+        results = {}
+        for concurrency in levels:
+            # Fresh ticket per level: a pair that was minted once is skipped
+            nft_id = await create_ticket(
+                client, headers, event_id, f"{source_image}?mint-{concurrency}"
+            )
+            scenarios = {
+                "login": (login_request(args.users), args.requests),
+                "get_events": (get_events, args.requests),
+                "create_ticket": (
+                    create_tickets(f"{time.time()}-{concurrency}"),
+                    args.ticket_requests,
+                ),
+                "mint_nft": (mint(nft_id), args.requests),
+            }
+            for name, (request, total) in scenarios.items():
+                stats = await run_load(request, concurrency, total, base_url)
+                results.setdefault(name, []).append(
+                    {"concurrency": concurrency, **stats}
+                )
+    return results
+
+
+async def main(args) -> dict:
+    load_dotenv()
+    stub_env = stubs.start(args.upstream_latency, args.image_size)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    results = {
+        "benchmark": "suite",
+        "started": time.time(),
+        "config": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+    }
+    process = start_api(port, args.workers, stub_env)
+    try:
+        await wait_ready(base_url, process)
+        results["endpoints"] = await bench_endpoints(
+            args, base_url, stub_env["source_image"]
+        )
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        for server in stub_env["servers"]:
+            server.shutdown()
+    if not args.skip_images:
+        results["images"] = images.run(parse_levels(args.image_sizes), args.repeat)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--concurrency", default="1,10,50")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument(
+        "--ticket-requests",
+        type=int,
+        default=100,
+        help="/create/ticket requests per level, each renders an image",
+    )
+    parser.add_argument("--users", type=int, default=500, help="login VK id pool")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=0.0,
+        help="seconds added to stub Quiknode/Pictshare responses",
+    )
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--image-sizes", default="512,1024,2048")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--skip-images", action="store_true")
+    parser.add_argument("--output", default=None, help="JSON results file")
+    args = parser.parse_args()
+    save(asyncio.run(main(args)), args.output)
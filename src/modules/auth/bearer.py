@@ -1,31 +1,81 @@
+import time
+from dataclasses import dataclass
+from os import getenv
+
 from fastapi import Request, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from .handler import decodeJWT
+from .state import AuthPair
+from modules.cache import TTLCache
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Identity carried by a verified access token"""
+
+    user_id: int  # VK ID
+    expires: float  # unix time
 
 
 class JWTBearer(HTTPBearer):
+    # Verified tokens shared by all instances, so hot tokens are decoded and
+    # checked against the revocation store once per JWT_CACHE_TTL seconds
+    # (never past their own expiry). A revoked token stops working on other
+    # API workers within that time. Created on first use, after .env loaded
+    cache_ttl: float | None = None
+    _cache: TTLCache | None = None
+    # Revoked tokens (modules.auth.state), set by the app. Validity otherwise
+    # only depends on the signature and expiry, no per-token state
+    store: AuthPair | None = None
+
+    @classmethod
+    def cache(cls) -> TTLCache:
+        if cls._cache is None:
+            cls.cache_ttl = float(getenv("JWT_CACHE_TTL", "60"))
+            cls._cache = TTLCache(int(getenv("JWT_CACHE_SIZE", "10000")))
+        return cls._cache
+
     def __init__(self, auto_error: bool = True):
         super(JWTBearer, self).__init__(auto_error=auto_error)
 
-    async def __call__(self, request: Request):
+    async def __call__(self, request: Request) -> Principal:
         credentials: HTTPAuthorizationCredentials = await super(JWTBearer, self).__call__(request)
         if credentials:
             if not credentials.scheme == "Bearer":
                 raise HTTPException(status_code=403, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(credentials.credentials):
+            principal = await self.verify_jwt(credentials.credentials)
+            if principal is None:
                 raise HTTPException(status_code=403, detail="Invalid token or expired token.")
-            return credentials.credentials
+            return principal
         else:
             raise HTTPException(status_code=403, detail="Invalid authorization code.")
 
-    def verify_jwt(self, jwtoken: str) -> bool:
-        isTokenValid: bool = False
+    async def verify_jwt(self, jwtoken: str) -> Principal | None:
+        principal = self.cache().get(jwtoken)
+        if principal is not None:
+            return principal
 
         try:
             payload = decodeJWT(jwtoken)
         except:
             payload = None
-        if payload:
-            isTokenValid = True
-        return isTokenValid
+        if not payload:
+            return None
+        if self.store is not None and await self.store.get(jwtoken) is not None:
+            return None  # Revoked (logged out)
+        principal = Principal(user_id=payload["user_id"], expires=payload["expires"])
+        self.cache().set(
+            jwtoken,
+            principal,
+            expires=min(time.time() + self.cache_ttl, principal.expires),
+        )
+        return principal
+
+    @classmethod
+    async def revoke(cls, jwtoken: str, principal: Principal) -> None:
+        """List a token in the revocation store until it expires, and drop
+        it from the verification cache"""
+        cls.cache().delete(jwtoken)
+        if cls.store is not None:
+            await cls.store.post(jwtoken, principal.user_id, principal.expires)
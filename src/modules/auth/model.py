@@ -49,6 +49,33 @@ class TicketCreateSchema(BaseModel):
         }
 
 
+class TicketBulkItemSchema(BaseModel):
+    name: str = Field(...)
+    description: str = Field(...)
+    image: str
+    keys: dict[str, str]
+
+
+class TicketBulkCreateSchema(BaseModel):
+    eventId: int
+    tickets: list[TicketBulkItemSchema] = Field(..., min_items=1, max_items=5000)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "eventId": 1,
+                "tickets": [
+                    {
+                        "name": "My NFT",
+                        "image": "https://i.ibb.co/28Wg0xd/pic-blur.png",
+                        "description": "An NFT commemorating a special day",
+                        "keys": {"type": "vip"},
+                    }
+                ],
+            }
+        }
+
+
 class TicketResponseSchema(BaseModel):
     id: int
     title: str = Field(...)
@@ -65,6 +92,33 @@ class TicketResponseSchema(BaseModel):
         orm_mode = True
 
 
+class BulkMintSchema(BaseModel):
+    nft_id: int
+    # VK ids, the event allowlist when omitted
+    recipients: list[int] | None = Field(None, max_items=10000)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "nft_id": 1,
+                "recipients": [123456789, 987654321],
+            }
+        }
+
+
+class AllowlistImportSchema(BaseModel):
+    eventId: int
+    vk_ids: list[int] = Field(..., max_items=100000)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "eventId": 1,
+                "vk_ids": [123456789, 987654321],
+            }
+        }
+
+
 class EventCreateSchema(BaseModel):
     title: str = Field(...)
     description: str = Field(...)
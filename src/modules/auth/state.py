@@ -1,13 +1,86 @@
 #!/usr/bin/env python3
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from hashlib import sha256
+from os import getenv
 from typing import Any
 
+from modules.cache import TTLCache
 
-class AuthPair:
-    def __init__(self):
-        self.store = {}  # {token: user_id}
 
-    def post(self, token, user_id):
-        self.store[token] = user_id
+class AuthPair(ABC):
+    """Revoked token store (logout denylist): {token: user_id} entries kept
+    until the token itself expires (the JWT `expires` claim, unix time).
+    Tokens missing from it are valid as long as their signature is"""
 
-    def get(self, token) -> Any:
+    @abstractmethod
+    async def post(self, token: str, user_id: int, expires: float) -> None:
+        ...
+
+    @abstractmethod
+    async def get(self, token: str) -> Any:
+        ...
+
+    @abstractmethod
+    async def delete(self, token: str) -> None:
+        ...
+
+
+class MemoryAuthPair(AuthPair):
+    """In-process LRU backend, bounded to `maxsize` tokens. Revocations are
+    only seen by this API worker and do not survive a restart"""
+
+    def __init__(self, maxsize: int = 100_000):
+        self.store = TTLCache(maxsize)  # {token: user_id}
+
+    async def post(self, token, user_id, expires):
+        self.store.set(token, user_id, expires=expires)
+
+    async def get(self, token) -> Any:
         return self.store.get(token)
+
+    async def delete(self, token):
+        self.store.delete(token)
+
+
+class PostgresAuthPair(AuthPair):
+    """Backend shared by all workers: the revoked_tokens table, keyed by
+    the sha256 of the token. Expired rows are ignored and purged at most
+    every `purge_interval` seconds"""
+
+    def __init__(self, adb, purge_interval: float = 600):
+        self.adb = adb
+        self.purge_interval = purge_interval
+        self._purged = 0.0
+
+    @staticmethod
+    def _hash(token: str) -> str:
+        return sha256(token.encode()).hexdigest()
+
+    async def post(self, token, user_id, expires):
+        async with self.adb.sessionmaker() as session:
+            await self.adb.save_revoked_token(
+                session, self._hash(token), user_id, datetime.utcfromtimestamp(expires)
+            )
+            if time.time() - self._purged > self.purge_interval:
+                self._purged = time.time()
+                await self.adb.purge_revoked_tokens(session)
+
+    async def get(self, token) -> Any:
+        async with self.adb.sessionmaker() as session:
+            return await self.adb.get_revoked_token(session, self._hash(token))
+
+    async def delete(self, token):
+        async with self.adb.sessionmaker() as session:
+            await self.adb.delete_revoked_token(session, self._hash(token))
+
+
+def create_authpair(adb) -> AuthPair:
+    """Backend chosen by SESSION_STORE: memory (default) or postgres"""
+    backend = getenv("SESSION_STORE", "memory").lower()
+    if backend == "postgres":
+        return PostgresAuthPair(adb)
+    if backend == "memory":
+        return MemoryAuthPair(int(getenv("SESSION_STORE_MAX", "100000")))
+    raise ValueError(f"Unknown SESSION_STORE {backend!r}")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TTLCache:
+    """LRU cache with per-entry expiry.
+    Entries expire `ttl` seconds after being set, or at the absolute unix
+    time passed as `expires`; at most `maxsize` entries are kept"""
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[Any, float | None]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, expires: float | None = None) -> None:
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def delete_prefix(self, *prefix) -> None:
+        """Delete all tuple keys starting with `prefix`"""
+        size = len(prefix)
+        for key in [
+            key
+            for key in self._entries
+            if isinstance(key, tuple) and key[:size] == prefix
+        ]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SWRCache:
+    """Stale-while-revalidate cache with singleflight loading.
+    A value is fresh for `ttl` seconds. For `stale` more seconds it is still
+    served while a single background refresh runs; after that callers wait
+    for a new load. Concurrent loads of one key share a single call"""
+
+    def __init__(self, maxsize: int, ttl: float, stale: float):
+        self.ttl = ttl
+        self._entries = TTLCache(maxsize, ttl=ttl + stale)  # {key: (loaded, value)}
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        # Per key, while loads of it run: how often it was invalidated, and
+        # how many loads run. A load only stores its value if the
+        # generation did not change meanwhile
+        self._generations: dict[Hashable, int] = {}
+        self._running: dict[Hashable, int] = {}
+
+    async def get(
+        self,
+        key: Hashable,
+        load: Callable[[], Awaitable],
+        cacheable: Callable[[Any], bool] = lambda value: True,
+    ) -> Any:
+        """Cached value of `key`, `await load()` fills it. Values for which
+        `cacheable` is false (upstream errors) are returned but not kept"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            loaded, value = entry
+            if time.time() - loaded > self.ttl:
+                self._load(key, load, cacheable)
+            return value
+        return await asyncio.shield(self._load(key, load, cacheable))
+
+    def _load(self, key, load, cacheable) -> asyncio.Future:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fill(key, load, cacheable))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    async def _fill(self, key, load, cacheable) -> Any:
+        generation = self._generations.get(key, 0)
+        self._running[key] = self._running.get(key, 0) + 1
+        try:
+            value = await load()
+            if cacheable(value) and self._generations.get(key, 0) == generation:
+                self._entries.set(key, (time.time(), value))
+            return value
+        finally:
+            self._running[key] -= 1
+            if not self._running[key]:
+                del self._running[key]
+                self._generations.pop(key, None)
+
+    def _done(self, key, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # Retrieve the exception of unawaited background refreshes
+        if not future.cancelled():
+            future.exception()
+
+    def invalidate(self, key: Hashable) -> None:
+        """Drop `key`. A load of it already running is not stored, and
+        later callers start a new one instead of joining it"""
+        self._entries.delete(key)
+        if key in self._running:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._inflight.pop(key, None)
+
+
+_missing = object()
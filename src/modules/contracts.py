@@ -1,24 +1,137 @@
-import requests
+import asyncio
+from os import getenv
+from typing import Any
+
+import httpx
 from jsonrpcclient import request, parse, Ok
 
-base_endpoint = "https://alpha-sleek-general.solana-devnet.discover.quiknode.pro/b511198243861757412f978f597d03eb715ce6a5/"
+from modules.metrics import UPSTREAM_ERRORS, track_upstream
+
 chain = "solana"
 
+# region HTTP client
+# Statuses worth another attempt (rate limiting and upstream hiccups)
+retry_statuses = {429, 502, 503, 504}
 
-async def create_collection(name: str, description: str, img_url: str):
-    """creates a collection via the Quiknode API"""
-    metadata = {"name": name, "description": description, "imageUrl": img_url}
+_client: httpx.AsyncClient | None = None
+_settings: dict | None = None
 
-    response = requests.post(
-        base_endpoint, json=request("cm_createCollection", [chain, metadata])
-    )
-    parsed = parse(response.json())
+
+def settings() -> dict:
+    """Connection settings, read from the environment on first use (so after
+    .env is loaded). Raises RuntimeError when QUIKNODE_URL is not set"""
+    global _settings
+    if _settings is None:
+        endpoint = getenv("QUIKNODE_URL")
+        if not endpoint:
+            raise RuntimeError("QUIKNODE_URL is not set")
+        _settings = {
+            "endpoint": endpoint,
+            "timeout": httpx.Timeout(
+                float(getenv("QUIKNODE_TIMEOUT", "15")),
+                connect=float(getenv("QUIKNODE_CONNECT_TIMEOUT", "5")),
+            ),
+            "limits": httpx.Limits(
+                max_connections=int(getenv("QUIKNODE_MAX_CONNECTIONS", "20")),
+                max_keepalive_connections=int(getenv("QUIKNODE_MAX_KEEPALIVE", "10")),
+            ),
+            "retries": int(getenv("QUIKNODE_RETRIES", "3")),
+            "backoff": float(getenv("QUIKNODE_BACKOFF", "0.5")),
+        }
+    return _settings
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared keep-alive client, created lazily inside the running event loop"""
+    global _client
+    if _client is None or _client.is_closed:
+        config = settings()
+        _client = httpx.AsyncClient(timeout=config["timeout"], limits=config["limits"])
+    return _client
+
+
+async def close() -> None:
+    """Close the shared client (call on application shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _post(payload: dict | list, idempotent: bool = True) -> Any:
+    """POSTs a JSON-RPC payload and returns the decoded body.
+    Retries with exponential backoff; non-idempotent calls (minting) are only
+    retried when the connection could not be established at all"""
+    operation = payload["method"] if isinstance(payload, dict) else "batch"
+    with track_upstream("quiknode", operation):
+        return await _post_retrying(payload, idempotent)
+
+
+async def _post_retrying(payload: dict | list, idempotent: bool) -> Any:
+    client, config = get_client(), settings()
+    attempt = 0
+    while True:
+        try:
+            response = await client.post(config["endpoint"], json=payload)
+            if response.status_code in retry_statuses:
+                response.raise_for_status()
+            return response.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or (
+                idempotent
+                and (
+                    isinstance(e, httpx.TransportError)
+                    or e.response.status_code in retry_statuses
+                )
+            )
+            if attempt >= config["retries"] or not retryable:
+                raise
+            await asyncio.sleep(config["backoff"] * 2**attempt)
+            attempt += 1
+
+
+async def call(method: str, params: list, idempotent: bool = True):
+    """Single JSON-RPC call, returns the result or {"error": ...}"""
+    parsed = parse(await _post(request(method, params), idempotent))
     if isinstance(parsed, Ok):
-        return parsed.result  # Returns the collection id and other data
+        return parsed.result
     else:
+        UPSTREAM_ERRORS.labels("quiknode", method).inc()
         return {"error": parsed}
 
 
+async def batch(calls: list[tuple[str, list]]) -> list:
+    """Sends several JSON-RPC calls in a single POST.
+    Returns results in the order of `calls`, failed entries as {"error": ...}"""
+    if not calls:
+        return []
+    payload = [request(method, params) for method, params in calls]
+    body = await _post(payload)
+    if not isinstance(body, list):
+        # The whole batch was rejected (e.g. invalid request)
+        return [{"error": parse(body)} for _ in payload]
+    by_id = {parsed.id: parsed for parsed in parse(body)}
+    results = []
+    for item in payload:
+        parsed = by_id.get(item["id"])
+        if isinstance(parsed, Ok):
+            results.append(parsed.result)
+        else:
+            UPSTREAM_ERRORS.labels("quiknode", item["method"]).inc()
+            results.append({"error": parsed})
+    return results
+
+
+# endregion
+
+
+async def create_collection(name: str, description: str, img_url: str):
+    """creates a collection via the Quiknode API"""
+    metadata = {"name": name, "description": description, "imageUrl": img_url}
+    # Returns the collection id and other data
+    return await call("cm_createCollection", [chain, metadata], idempotent=False)
+
+
 async def mint_nft(
     collection_id: str,
     name: str,
@@ -39,34 +152,27 @@ async def mint_nft(
         "attributes": atrs,
     }
     addr = f"solana:{wallet_addr}"
-    response = requests.post(
-        base_endpoint,
-        json=request("cm_mintNFT", [collection_id, addr, nft_config]),
+    # returns the nft id and other data
+    return await call(
+        "cm_mintNFT", [collection_id, addr, nft_config], idempotent=False
     )
-    parsed = parse(response.json())
-    if isinstance(parsed, Ok):
-        return parsed.result  # returns the nft id and other data
-    else:
-        return {"error": parsed}
 
 
-def check_minting_status(nft_id: str, collection_id: str) -> dict:
+async def check_minting_status(nft_id: str, collection_id: str) -> dict:
     """Checks the minting status of an NFT via the Quiknode API"""
-    response = requests.post(
-        base_endpoint, json=request("cm_getNFTMintStatus", [collection_id, nft_id])
+    return await call("cm_getNFTMintStatus", [collection_id, nft_id])
+
+
+async def check_minting_statuses(pairs: list[tuple[str, str]]) -> list[dict]:
+    """Checks the minting status of several (nft_id, collection_id) pairs in one batch"""
+    return await batch(
+        [
+            ("cm_getNFTMintStatus", [collection_id, nft_id])
+            for nft_id, collection_id in pairs
+        ]
     )
-    parsed = parse(response.json())
-    if isinstance(parsed, Ok):
-        return parsed.result
-    else:
-        return {"error": parsed}
 
 
 async def get_all_nfts(wallet_addr: str):
     """Gets all NFTs owned by a wallet via the Quiknode API"""
-    response = requests.post(base_endpoint, json=request("qn_fetchNFTs", [wallet_addr]))
-    parsed = parse(response.json())
-    if isinstance(parsed, Ok):
-        return parsed.result
-    else:
-        return {"error": parsed}
+    return await call("qn_fetchNFTs", [wallet_addr])
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 # region Dependencies
 import asyncio
+import binascii
 import json
 import string
 from random import choice
-from datetime import date, datetime, timedelta
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime, timedelta, timezone
+from io import StringIO
 from os import getenv
-from time import sleep, mktime
+from time import sleep
+from uuid import uuid4
+import asyncpg
 from sqlalchemy.orm import sessionmaker
-from modules.models import Base, User, Event, UserAllowlist, NFT
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from modules.models import Base, User, Event, UserAllowlist, NFT, Mint, RevokedToken, Job
 from modules.contracts import mint_nft, create_collection
+from modules.migrations import Migrator
+from modules.cache import TTLCache
+from modules.metrics import instrument_engine
 from modules.auth.model import (
     UserLoginSchema,
     UserSimpleLoginSchema,
@@ -17,8 +26,10 @@ from modules.auth.model import (
     TicketCreateSchema,
     TicketResponseSchema,
 )
-from sqlalchemy import create_engine
-from typing import List, Union
+from sqlalchemy import create_engine, select, insert, update, delete, bindparam, func
+from sqlalchemy import cast, BigInteger, Float, tuple_, literal, and_, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import AsyncIterator, List, Union
 from sqlalchemy.exc import OperationalError as sqlalchemyOpError
 from psycopg2 import OperationalError as psycopg2OpError
 import requests as req
@@ -27,6 +38,162 @@ from modules.nftimage.nftimage import NFTImage
 # endregion
 
 
+def pool_options() -> dict:
+    """Connection pool settings shared by the sync and async engines"""
+    return {
+        "pool_size": int(getenv("PG_POOL_SIZE", "10")),
+        "max_overflow": int(getenv("PG_POOL_MAX_OVERFLOW", "5")),
+        "pool_timeout": float(getenv("PG_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(getenv("PG_POOL_RECYCLE", "1800")),
+    }
+
+
+# Read cache miss marker (None is a valid cached value)
+_MISS = object()
+# NOTIFY channel of read cache invalidations
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+# region Projections
+# Read paths select exactly the columns they return, already named and
+# converted (datetime -> unix time) in SQL, so rows serialize as they are
+# and no ORM objects or lazy loads are involved
+# VK ids on the allowlist of the selected event, as an array
+ALLOWLIST_ARRAY = func.array(
+    select(UserAllowlist.user_id)
+    .filter(UserAllowlist.event_id == Event.id)
+    .order_by(UserAllowlist.user_id)
+    .scalar_subquery()
+)
+EVENT_COLUMNS = (
+    Event.id.label("event_id"),
+    Event.title,
+    Event.description,
+    cast(func.extract("epoch", Event.datetime), Float).label("datetime"),
+    Event.tickets,
+    Event.collectionID.label("collection_id"),
+    Event.place,
+    Event.ownerID.label("owner_id"),
+    ALLOWLIST_ARRAY.label("allowlist"),
+)
+# Public user columns
+USER_COLUMNS = (User.vk_id, User.wallet_public_key)
+# Columns of TicketResponseSchema
+TICKET_COLUMNS = (
+    NFT.id,
+    NFT.title,
+    NFT.description,
+    NFT.blurredImage,
+    NFT.eventId,
+    NFT.attended,
+)
+
+
+# Job status as reported by the API
+JOB_COLUMNS = (
+    Job.id,
+    Job.type,
+    Job.status,
+    Job.attempts,
+    Job.maxAttempts.label("max_attempts"),
+    Job.progress,
+    Job.result,
+    Job.error,
+    cast(func.extract("epoch", Job.created), Float).label("created"),
+    cast(func.extract("epoch", Job.finished), Float).label("finished"),
+)
+
+
+def allowlist_query(event_id: int):
+    """VK ids on the allowlist of an event, a primary key range scan"""
+    return (
+        select(UserAllowlist.user_id)
+        .filter(UserAllowlist.event_id == event_id)
+        .order_by(UserAllowlist.user_id)
+    )
+
+
+# endregion
+
+# region Pagination
+def encode_cursor(values: list) -> str:
+    """Opaque keyset cursor from the sort key values of the last item"""
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def select_fields(columns: tuple, fields: list[str] | None, required: tuple) -> list:
+    """Columns of a sparse field selection, `required` ones are always kept"""
+    by_key = {column.key: column for column in columns}
+    if not fields:
+        return list(columns)
+    unknown = set(fields) - set(by_key)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return [by_key[key] for key in by_key if key in fields or key in required]
+
+
+def cursor_value_fits(column, value) -> bool:
+    """Whether a decoded cursor value can be bound to its sort column"""
+    python_type = column.type.python_type
+    if python_type is int:
+        bits = 63 if isinstance(column.type, BigInteger) else 31
+        return (
+            isinstance(value, int)
+            and not isinstance(value, bool)
+            and -(2**bits) <= value < 2**bits
+        )
+    return isinstance(value, python_type)
+
+
+def keyset(stmt, order: tuple, after: list | None, limit: int):
+    """Order by `order`, continue after the row whose `order` values are
+    `after`, fetch one extra row to know whether there is a next page.
+    ValueError when `after` does not match the types of `order`"""
+    if after is not None:
+        if len(after) != len(order) or not all(
+            cursor_value_fits(column, value) for column, value in zip(order, after)
+        ):
+            raise ValueError("Invalid cursor")
+        if len(order) == 1:
+            stmt = stmt.filter(order[0] > after[0])
+        else:
+            stmt = stmt.filter(tuple_(*order) > tuple_(*map(literal, after)))
+    return stmt.order_by(*order).limit(limit + 1)
+
+
+def page(rows, limit: int, cursor_of) -> dict:
+    """{"items": [...], "next_cursor": ...} from keyset() rows.
+    Columns labelled with a leading underscore only feed the cursor"""
+    items = [dict(row) for row in rows]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(cursor_of(items[-1]))
+    for item in items:
+        for key in [key for key in item if key.startswith("_")]:
+            del item[key]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def naive_utc(value: datetime | None) -> datetime | None:
+    """Timestamps are stored without a time zone, in UTC"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# endregion
+
+
 class DBManager:
     def __init__(self, log, itools):
         self.pg_user = getenv("PG_USER")
@@ -57,7 +224,9 @@ class DBManager:
         self.engine = create_engine(
             f"postgresql+psycopg2://{self.pg_user}:{self.pg_pass}@{self.pg_host}:{self.pg_port}/{self.pg_db}",
             pool_pre_ping=True,
+            **pool_options(),
         )
+        instrument_engine(self.engine)
         Base.metadata.bind = self.engine
         db_session = sessionmaker(bind=self.engine)
         self.session = db_session()
@@ -72,9 +241,10 @@ class DBManager:
         Base.metadata.create_all(self.engine)
 
     def _update_db(self) -> None:
-        """Create the database structure if it doesn't exist (update)"""
-        # Create the tables if they don't exist
-        Base.metadata.create_all(self.engine)
+        """Create missing tables, apply pending migrations and check indexes"""
+        migrator = Migrator(self.log, self.engine)
+        migrator.migrate()
+        migrator.verify()
 
     # endregion
 
@@ -217,52 +387,829 @@ class DBManager:
         self.session.refresh(db_nft)
         self.session.commit()
 
-    def get_nfts(self, event_id: int) -> list[TicketResponseSchema]:
-        db_tickets = self.session.query(NFT).filter(NFT.eventId == event_id)
-        return [TicketResponseSchema.from_orm(ticket) for ticket in db_tickets]
+    def get_nfts(self, event_id: int) -> list[dict]:
+        return [
+            dict(ticket)
+            for ticket in self.session.execute(
+                select(*TICKET_COLUMNS).filter(NFT.eventId == event_id)
+            ).mappings()
+        ]
 
-    def get_event(self, event_id: int) -> dict:
-        event = self.session.query(Event).filter(Event.id == event_id).one_or_none()
-        return {
-            "event_id": event.id,
-            "title": event.title,
-            "description": event.description,
-            "datetime": mktime(event.datetime.timetuple()),
-            "tickets": event.tickets,
-            "collection_id": event.collectionID,
-            "place": event.place,
-            "owner_id": event.ownerID,
-            "allowlist": event.allowList,
-        }
+    def get_event(self, event_id: int) -> dict | None:
+        event = (
+            self.session.execute(select(*EVENT_COLUMNS).filter(Event.id == event_id))
+            .mappings()
+            .first()
+        )
+        return dict(event) if event else None
 
     def get_events(self) -> List[dict]:
-        """{ event_id: {'title': title, 'description': description, 'time': timestamp, 'tickets': [tickets], 'collection_id': collectionID, 'place': place, 'owner_id': ownerID, 'allowlist': allowList} }"""
-        # Get all events from DB
-        events = self.session.query(Event)
-        # Prepare the result
-        result = []
-        for event in events:
-            result.append(
-                {
-                    "event_id": event.id,
-                    "title": event.title,
-                    "description": event.description,
-                    "datetime": mktime(event.datetime.timetuple()),
-                    "tickets": event.tickets,
-                    "collection_id": event.collectionID,
-                    "place": event.place,
-                    "owner_id": event.ownerID,
-                    "allowlist": event.allowList,
-                }
-            )
-        return result
+        """[{'event_id': id, 'title': title, 'description': description, 'datetime': timestamp, 'tickets': [tickets], 'collection_id': collectionID, 'place': place, 'owner_id': ownerID, 'allowlist': allowList}]"""
+        return [
+            dict(event)
+            for event in self.session.execute(
+                select(*EVENT_COLUMNS).order_by(Event.id)
+            ).mappings()
+        ]
 
     def get_event_allowlist(self, event_id: int) -> List[int]:
         """[vk_id]"""
-        # Get event from DB
-        event = self.session.query(Event).filter(Event.id == event_id).first()
-        # Prepare the result
-        result = []
-        for user in event.allowlist:
-            result.append(user.vk_id)
-        return result
+        return list(self.session.execute(allowlist_query(event_id)).scalars())
+
+    def import_allowlist(self, event_id: int, vk_ids: List[int]) -> int:
+        """Add VK ids to the allowlist of an event with COPY, returns how many
+        were new. Blocking, run it in a thread from async code"""
+        rows = "".join(f"{int(vk_id)}\n" for vk_id in vk_ids)
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE TEMP TABLE allowlist_import (user_id INTEGER)"
+                    " ON COMMIT DROP"
+                )
+                cursor.copy_expert(
+                    "COPY allowlist_import (user_id) FROM STDIN", StringIO(rows)
+                )
+                cursor.execute(
+                    "INSERT INTO user_allowlists (event_id, user_id)"
+                    " SELECT DISTINCT %s, user_id FROM allowlist_import"
+                    " ON CONFLICT DO NOTHING",
+                    (event_id,),
+                )
+                added = cursor.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        return added
+
+
+class AsyncDBManager:
+    """Async counterpart of DBManager (SQLAlchemy asyncio + asyncpg).
+    Every request gets its own AsyncSession from a bounded connection pool,
+    see AsyncDBManager.session for the FastAPI dependency"""
+
+    def __init__(self, log):
+        self.pg_user = getenv("PG_USER")
+        self.pg_pass = getenv("PG_PASS")
+        self.pg_host = getenv("PG_HOST")
+        self.pg_port = getenv("PG_PORT")
+        self.pg_db = getenv("PG_DB")
+        self.log = log
+        # Read-through cache of event and ticket reads. Writes invalidate it
+        # here and, via NOTIFY, in the processes that listen(); READ_CACHE_TTL
+        # bounds staleness when a notification is lost
+        self.cache = TTLCache(
+            int(getenv("READ_CACHE_SIZE", "1024")),
+            ttl=float(getenv("READ_CACHE_TTL", "30")),
+        )
+        self.notify = getenv("READ_CACHE_NOTIFY", "true") == "true"
+        # {kind: [callback(key)]} for caches kept outside, e.g. "wallet"
+        self.on_invalidate: dict[str, list] = {}
+        self._origin = uuid4().hex  # Skips our own notifications
+        self._notifications: set[asyncio.Task] = set()
+        self._listener: asyncio.Task | None = None
+        self._connect()
+
+    # region Connection setup
+    def _connect(self) -> None:
+        """Create the async engine and the session factory"""
+        self.engine = create_async_engine(
+            f"postgresql+asyncpg://{self.pg_user}:{self.pg_pass}@{self.pg_host}:{self.pg_port}/{self.pg_db}",
+            pool_pre_ping=True,
+            **pool_options(),
+        )
+        instrument_engine(self.engine.sync_engine)
+        self.sessionmaker = sessionmaker(
+            bind=self.engine, class_=AsyncSession, expire_on_commit=False
+        )
+
+    async def close(self) -> None:
+        """Dispose of the pool (call on application shutdown)"""
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        # Deliver the pending invalidations
+        await asyncio.gather(*self._notifications, return_exceptions=True)
+        await self.engine.dispose()
+
+    async def session(self) -> AsyncIterator[AsyncSession]:
+        """FastAPI dependency: yields a session bound to the current request"""
+        async with self.sessionmaker() as session:
+            yield session
+
+    # endregion
+
+    # region Read cache
+    async def _cached(self, key: tuple, load):
+        """Value of `key` from the read cache, `await load()` on a miss"""
+        value = self.cache.get(key, _MISS)
+        if value is _MISS:
+            value = await load()
+            self.cache.set(key, value)
+        return value
+
+    def invalidate_events(self, event_id: int | None = None) -> None:
+        """Drop cached event lists (and the event itself)"""
+        self.invalidate("events", event_id)
+
+    def invalidate_nfts(self, event_id: int | None = None) -> None:
+        """Drop cached tickets of one event, or of all events"""
+        self.invalidate("nfts", event_id)
+
+    def invalidate(self, kind: str, key=None) -> None:
+        """Drop cached entries in this process and, with READ_CACHE_NOTIFY,
+        in every process that listen()s"""
+        self._drop(kind, key)
+        if self.notify:
+            payload = json.dumps({"origin": self._origin, "kind": kind, "key": key})
+            task = asyncio.get_running_loop().create_task(self._publish(payload))
+            self._notifications.add(task)
+            task.add_done_callback(self._notifications.discard)
+
+    def _drop(self, kind: str, key) -> None:
+        if kind == "events":
+            self.cache.delete_prefix("events")
+            if key is not None:
+                self.cache.delete(("event", key))
+        elif kind == "nfts":
+            if key is None:
+                self.cache.delete_prefix("nfts")
+            else:
+                self.cache.delete_prefix("nfts", key)
+        elif kind == "allowlist":
+            self.cache.delete(("allowlist", key))
+            self._drop("events", key)
+        for callback in self.on_invalidate.get(kind, []):
+            callback(key)
+
+    async def _publish(self, payload: str) -> None:
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(select(func.pg_notify(INVALIDATION_CHANNEL, payload)))
+        except Exception as e:
+            self.log.warning(f"Could not send cache invalidation {payload}: {e!r}")
+
+    def listen(self) -> None:
+        """Apply the invalidations of other processes (API workers, worker.py)
+        to this read cache. Call inside the running event loop"""
+        if self.notify and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                connection = await asyncpg.connect(
+                    user=self.pg_user,
+                    password=self.pg_pass,
+                    host=self.pg_host,
+                    port=self.pg_port,
+                    database=self.pg_db,
+                )
+            except Exception as e:
+                self.log.warning(f"Cache invalidation listener cannot connect: {e!r}")
+                await asyncio.sleep(5)
+                continue
+            try:
+                await connection.add_listener(INVALIDATION_CHANNEL, self._on_notification)
+                # Notifications sent while we were not listening are lost
+                self.cache.clear()
+                while True:
+                    await asyncio.sleep(30)
+                    await connection.execute("SELECT 1")  # Raises once it is gone
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.warning(f"Cache invalidation listener lost: {e!r}")
+            finally:
+                connection.terminate()
+            await asyncio.sleep(1)
+
+    def _on_notification(self, connection, pid, channel, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+            if message["origin"] != self._origin:
+                self._drop(message["kind"], message["key"])
+        except Exception as e:
+            self.log.warning(f"Bad cache invalidation {payload!r}: {e!r}")
+
+    # endregion
+
+    async def user_exists(self, session: AsyncSession, vk_id: int) -> bool:
+        """Check if user exists in the database"""
+        result = await session.execute(
+            select(User.id).filter(User.vk_id == vk_id).limit(1)
+        )
+        return result.first() is not None
+
+    async def get_users_test(self, session: AsyncSession) -> dict:
+        """Get all users from the database"""
+        result = await session.execute(
+            select(User.vk_id, User.wallet_public_key, User.first_name, User.last_name)
+        )
+        return {
+            user.vk_id: {
+                "wallet_public_key": user.wallet_public_key,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+            }
+            for user in result
+        }
+
+    async def get_users(
+        self,
+        session: AsyncSession,
+        limit: int = 50,
+        cursor: str | None = None,
+        fields: list[str] | None = None,
+    ) -> dict:
+        """One page of users ordered by id, see page()"""
+        columns = select_fields(USER_COLUMNS, fields, ("vk_id",))
+        stmt = keyset(
+            select(*columns, User.id.label("_id")),
+            (User.id,),
+            decode_cursor(cursor) if cursor else None,
+            limit,
+        )
+        result = await session.execute(stmt)
+        return page(result.mappings(), limit, lambda item: [item["_id"]])
+
+    async def auth(
+        self,
+        session: AsyncSession,
+        vk_id: int,
+        wallet_public_key: str,
+        first_name: str,
+        last_name: str,
+    ) -> bool:
+        """Create or update a user in one INSERT ... ON CONFLICT statement
+        Returns True if successful, False if user is not found and no wallet is provided"""
+        if not wallet_public_key or not first_name or not last_name:
+            # Nothing to write, the user has to exist already
+            return await self.user_exists(session, vk_id)
+        table = User.__table__
+        stmt = pg_insert(table).values(
+            vk_id=vk_id,
+            first_name=first_name,
+            last_name=last_name,
+            wallet_public_key=wallet_public_key,
+        )
+        result = await session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[table.c.vk_id],
+                set_={
+                    "first_name": stmt.excluded.first_name,
+                    "last_name": stmt.excluded.last_name,
+                    "wallet_public_key": stmt.excluded.wallet_public_key,
+                },
+            ).returning(table.c.id)
+        )
+        await session.commit()
+        return result.scalar() is not None
+
+    # region Revoked tokens
+    async def save_revoked_token(
+        self, session: AsyncSession, token_hash: str, user_id: int, expires: datetime
+    ) -> None:
+        stmt = pg_insert(RevokedToken.__table__).values(
+            token=token_hash, user_id=user_id, expires=expires
+        )
+        await session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["token"],
+                set_={"user_id": stmt.excluded.user_id, "expires": stmt.excluded.expires},
+            )
+        )
+        await session.commit()
+
+    async def get_revoked_token(
+        self, session: AsyncSession, token_hash: str
+    ) -> int | None:
+        """User id of a revoked token that has not expired yet"""
+        result = await session.execute(
+            select(RevokedToken.user_id).filter(
+                RevokedToken.token == token_hash,
+                RevokedToken.expires > datetime.utcnow(),
+            )
+        )
+        return result.scalar()
+
+    async def delete_revoked_token(self, session: AsyncSession, token_hash: str) -> None:
+        await session.execute(
+            delete(RevokedToken.__table__).where(RevokedToken.token == token_hash)
+        )
+        await session.commit()
+
+    async def purge_revoked_tokens(self, session: AsyncSession) -> None:
+        """Drop entries of expired tokens, they are refused anyway"""
+        await session.execute(
+            delete(RevokedToken.__table__).where(
+                RevokedToken.expires <= datetime.utcnow()
+            )
+        )
+        await session.commit()
+
+    # endregion
+
+    async def get_user(self, session: AsyncSession, vk_id: int) -> User | None:
+        """Get user object by VK ID"""
+        result = await session.execute(select(User).filter(User.vk_id == vk_id))
+        return result.scalars().first()
+
+    async def get_user_id(self, session: AsyncSession, vk_id: int) -> int | None:
+        """Get internal user id by VK ID"""
+        result = await session.execute(select(User.id).filter(User.vk_id == vk_id))
+        return result.scalars().first()
+
+    async def get_user_wallet(self, session: AsyncSession, vk_id: int) -> str | None:
+        """Get user wallet from the database"""
+        result = await session.execute(
+            select(User.wallet_public_key).filter(User.vk_id == vk_id)
+        )
+        return result.scalars().first()
+
+    async def create_event(
+        self,
+        session: AsyncSession,
+        event_data: EventCreateSchema,
+        user_id: int,
+        collection_id: str,
+    ) -> Event:
+        db_event = Event(
+            title=event_data.title,
+            description=event_data.description,
+            place=event_data.place,
+            ownerID=await self.get_user_id(session, user_id),
+            datetime=event_data.datetime,
+            collectionID=collection_id,
+        )
+        session.add(db_event)
+        await session.commit()
+        self.invalidate_events(db_event.id)
+        return db_event
+
+    async def create_nft(
+        self,
+        session: AsyncSession,
+        ticket_data: TicketCreateSchema,
+        mint_img: str,
+        blur_img: str,
+    ) -> NFT:
+        """Store a ticket whose images were already processed and uploaded"""
+        db_nft = NFT(
+            **self.nft_values(ticket_data, ticket_data.eventId, mint_img, blur_img)
+        )
+        session.add(db_nft)
+        await session.commit()
+        self.invalidate_nfts(ticket_data.eventId)
+        return db_nft
+
+    @staticmethod
+    def nft_values(ticket_data, event_id: int, mint_img: str, blur_img: str) -> dict:
+        """Column values of a new ticket"""
+        return {
+            "title": ticket_data.name,
+            "description": ticket_data.description,
+            "mintImage": mint_img,
+            "blurredImage": blur_img,
+            "properties": json.dumps(ticket_data.keys),
+            "eventId": event_id,
+            "imageKey": "".join(
+                choice(string.ascii_uppercase + string.digits) for _ in range(20)
+            ),
+        }
+
+    async def insert_nfts(self, session: AsyncSession, rows: list[dict]) -> list[int]:
+        """Insert tickets (see nft_values) with one multi-row INSERT.
+        Returns their ids in the order of `rows`. Does not commit, call
+        invalidate_nfts after committing"""
+        if not rows:
+            return []
+        table = NFT.__table__
+        result = await session.execute(
+            insert(table).values(rows).returning(table.c.id, table.c.imageKey)
+        )
+        # RETURNING does not follow the VALUES order, rows are matched back
+        # by their random imageKey
+        ids = {row.imageKey: row.id for row in result}
+        if len(ids) != len(rows):
+            raise RuntimeError("Duplicate imageKey in a ticket batch")
+        return [ids[row["imageKey"]] for row in rows]
+
+    async def get_nft(self, session: AsyncSession, nft_id: int) -> NFT | None:
+        result = await session.execute(select(NFT).filter(NFT.id == nft_id))
+        return result.scalars().one_or_none()
+
+    async def update_mint(self, session: AsyncSession, nft_id: int, mintHash: str):
+        db_nft = await self.get_nft(session, nft_id)
+        db_nft.mintHash = mintHash
+        await session.commit()
+        self.invalidate_nfts(db_nft.eventId)
+
+    async def update_mints(self, session: AsyncSession, hashes: dict[int, str]):
+        """Bulk version of update_mint: {nft_id: mintHash} in one executemany"""
+        if not hashes:
+            return
+        await session.execute(
+            update(NFT.__table__)
+            .where(NFT.__table__.c.id == bindparam("b_id"))
+            .values(mintHash=bindparam("b_hash")),
+            [{"b_id": nft_id, "b_hash": mint_hash} for nft_id, mint_hash in hashes.items()],
+        )
+        await session.commit()
+        self.invalidate_nfts()
+
+    # region Job queue
+    async def enqueue_job(
+        self, session: AsyncSession, job_type: str, payload: dict, max_attempts: int
+    ) -> str:
+        job_id = uuid4().hex
+        session.add(
+            Job(
+                id=job_id,
+                type=job_type,
+                payload=payload,
+                maxAttempts=max_attempts,
+                runAt=datetime.utcnow(),
+            )
+        )
+        await session.commit()
+        return job_id
+
+    async def claim_jobs(
+        self, session: AsyncSession, job_type: str, limit: int, lease: float
+    ) -> list[Job]:
+        """Lease due queued jobs (and running ones whose lease ran out, their
+        worker is gone) for `lease` seconds; other workers skip them"""
+        now = datetime.utcnow()
+        result = await session.execute(
+            select(Job)
+            .filter(
+                Job.type == job_type,
+                or_(
+                    and_(Job.status == "queued", Job.runAt <= now),
+                    and_(Job.status == "running", Job.lockedUntil < now),
+                ),
+            )
+            .order_by(Job.runAt)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        jobs = list(result.scalars())
+        for job in jobs:
+            job.status = "running"
+            job.attempts += 1
+            job.lockedUntil = now + timedelta(seconds=lease)
+        await session.commit()
+        return jobs
+
+    async def renew_job(
+        self,
+        session: AsyncSession,
+        job_id: str,
+        attempt: int,
+        lease: float,
+        progress: dict | None,
+    ) -> bool:
+        """Extend the lease of a running job and save its progress. False
+        when `attempt` no longer holds the lease (another worker claimed it)"""
+        result = await session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "running", Job.attempts == attempt)
+            .values(
+                lockedUntil=datetime.utcnow() + timedelta(seconds=lease),
+                progress=progress,
+            )
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+    async def finish_job(
+        self,
+        session: AsyncSession,
+        job_id: str,
+        attempt: int,
+        status: str,
+        progress: dict | None = None,
+        result=None,
+        error: str | None = None,
+        retry_at: datetime | None = None,
+    ) -> bool:
+        """Record the outcome of an attempt: done, failed, or queued again
+        for `retry_at`. Only the attempt holding the lease may, returns
+        whether it did"""
+        values = {"status": status, "progress": progress, "lockedUntil": None}
+        if status == "queued":
+            values.update(runAt=retry_at, error=error)
+        else:
+            values.update(result=result, error=error, finished=datetime.utcnow())
+        updated = await session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "running", Job.attempts == attempt)
+            .values(**values)
+        )
+        await session.commit()
+        return updated.rowcount > 0
+
+    async def next_job_run(
+        self, session: AsyncSession, job_types: list[str]
+    ) -> datetime | None:
+        """When the earliest queued job of these types is due"""
+        result = await session.execute(
+            select(func.min(Job.runAt)).filter(
+                Job.type.in_(job_types), Job.status == "queued"
+            )
+        )
+        return result.scalar()
+
+    async def get_job(self, session: AsyncSession, job_id: str) -> dict | None:
+        result = await session.execute(select(*JOB_COLUMNS).filter(Job.id == job_id))
+        job = result.mappings().first()
+        return dict(job) if job else None
+
+    async def get_jobs(
+        self,
+        session: AsyncSession,
+        limit: int = 50,
+        cursor: str | None = None,
+        job_type: str | None = None,
+        status: str | None = None,
+    ) -> dict:
+        """One page of jobs, oldest first, see page()"""
+        stmt = select(*JOB_COLUMNS, Job.created.label("_created"))
+        if job_type is not None:
+            stmt = stmt.filter(Job.type == job_type)
+        if status is not None:
+            stmt = stmt.filter(Job.status == status)
+        after = decode_cursor(cursor) if cursor else None
+        if after is not None:
+            try:
+                after = [datetime.fromisoformat(after[0]), *after[1:]]
+            except (TypeError, ValueError, IndexError):
+                raise ValueError("Invalid cursor")
+        result = await session.execute(keyset(stmt, (Job.created, Job.id), after, limit))
+        return page(
+            result.mappings(),
+            limit,
+            lambda item: [item["_created"].isoformat(), item["id"]],
+        )
+
+    # endregion
+
+    # region Mint tracking
+    async def get_mint_context(self, session: AsyncSession, nft_id: int):
+        """(NFT, collection id, event allowlist) in one query, None if missing"""
+        result = await session.execute(
+            select(NFT, Event.collectionID, ALLOWLIST_ARRAY)
+            .join(Event, NFT.eventId == Event.id)
+            .filter(NFT.id == nft_id)
+        )
+        return result.first()
+
+    async def get_wallets(self, session: AsyncSession, vk_ids: list[int]) -> dict:
+        """{vk_id: wallet} for all given users in one query"""
+        result = await session.execute(
+            select(User.vk_id, User.wallet_public_key).filter(User.vk_id.in_(vk_ids))
+        )
+        return {row.vk_id: row.wallet_public_key for row in result}
+
+    async def reserve_mints(
+        self, session: AsyncSession, nft_id: int, collection_id: str, wallets: list[str]
+    ) -> dict[str, int]:
+        """Insert "minting" rows for (nft_id, wallet) pairs that have no live
+        mint yet. Returns {wallet: mint row id} of the reserved ones only"""
+        if not wallets:
+            return {}
+        now = datetime.utcnow()
+        result = await session.execute(
+            pg_insert(Mint.__table__)
+            .values(
+                [
+                    {
+                        "nftId": nft_id,
+                        "wallet": wallet,
+                        "collectionID": collection_id,
+                        "status": "minting",
+                        "nextCheck": now,
+                    }
+                    for wallet in wallets
+                ]
+            )
+            # Conflicts with ix_mints_nft_wallet (one live mint per pair).
+            # No conflict target: it must not fail where the index is missing
+            .on_conflict_do_nothing()
+            .returning(Mint.__table__.c.id, Mint.__table__.c.wallet)
+        )
+        reserved = {row.wallet: row.id for row in result}
+        await session.commit()
+        return reserved
+
+    async def save_mint_requests(self, session: AsyncSession, rows: list[dict]):
+        """Bulk update of reserved mints: dicts with b_id, b_mint_id, b_status.
+        Reservations that expire_reservations() already failed are left alone"""
+        if not rows:
+            return
+        table = Mint.__table__
+        await session.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"), table.c.status == "minting")
+            .values(
+                mintId=bindparam("b_mint_id"),
+                status=bindparam("b_status"),
+                nextCheck=bindparam("b_next"),
+            ),
+            [{"b_next": datetime.utcnow(), **row} for row in rows],
+        )
+        await session.commit()
+
+    async def expire_reservations(self, session: AsyncSession, timeout: float) -> int:
+        """Fail "minting" rows reserved more than `timeout` seconds ago: their
+        cm_mintNFT call never got an answer (process died, call cancelled).
+        Frees the (nft, wallet) pair for another attempt. Returns the count"""
+        table = Mint.__table__
+        result = await session.execute(
+            update(table)
+            .where(
+                table.c.status == "minting",
+                table.c.created < func.now() - timedelta(seconds=timeout),
+            )
+            .values(status="failed")
+        )
+        await session.commit()
+        return result.rowcount
+
+    async def claim_due_mints(
+        self, session: AsyncSession, limit: int, lease: float
+    ) -> list[Mint]:
+        """Pick pending mints whose check is due and push their nextCheck
+        `lease` seconds ahead, so other workers skip them meanwhile"""
+        now = datetime.utcnow()
+        result = await session.execute(
+            select(Mint)
+            .filter(Mint.status == "pending", Mint.nextCheck <= now)
+            .order_by(Mint.nextCheck)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        mints = list(result.scalars())
+        for db_mint in mints:
+            db_mint.nextCheck = now + timedelta(seconds=lease)
+        await session.commit()
+        return mints
+
+    async def next_mint_check(self, session: AsyncSession) -> datetime | None:
+        """When the earliest pending mint is due"""
+        result = await session.execute(
+            select(func.min(Mint.nextCheck)).filter(Mint.status == "pending")
+        )
+        return result.scalar()
+
+    async def save_mint_checks(self, session: AsyncSession, checks: list[dict]):
+        """Bulk update of mint rows: dicts with b_id, b_status, b_hash, b_attempts, b_next"""
+        if not checks:
+            return
+        table = Mint.__table__
+        await session.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(
+                status=bindparam("b_status"),
+                mintHash=bindparam("b_hash"),
+                attempts=bindparam("b_attempts"),
+                nextCheck=bindparam("b_next"),
+            ),
+            checks,
+        )
+        await session.commit()
+
+    # endregion
+
+    async def get_nfts(
+        self,
+        session: AsyncSession,
+        event_id: int,
+        limit: int = 50,
+        cursor: str | None = None,
+        fields: list[str] | None = None,
+    ) -> dict:
+        """One page of the tickets of an event ordered by id, see page()"""
+        columns = select_fields(TICKET_COLUMNS, fields, ("id",))
+        stmt = keyset(
+            select(*columns).filter(NFT.eventId == event_id),
+            (NFT.id,),
+            decode_cursor(cursor) if cursor else None,
+            limit,
+        )
+
+        async def load():
+            result = await session.execute(stmt)
+            return page(result.mappings(), limit, lambda item: [item["id"]])
+
+        key = ("nfts", event_id, limit, cursor, tuple(fields or ()))
+        return await self._cached(key, load)
+
+    async def get_event(self, session: AsyncSession, event_id: int) -> dict | None:
+        async def load():
+            result = await session.execute(
+                select(*EVENT_COLUMNS).filter(Event.id == event_id)
+            )
+            event = result.mappings().first()
+            return dict(event) if event else None
+
+        return await self._cached(("event", event_id), load)
+
+    async def get_events(
+        self,
+        session: AsyncSession,
+        limit: int = 50,
+        cursor: str | None = None,
+        fields: list[str] | None = None,
+        owner_id: int | None = None,
+        date_from: datetime | None = None,
+        date_to: datetime | None = None,
+        upcoming: bool = False,
+        order: str = "id",
+    ) -> dict:
+        """One page of events (items in the DBManager.get_events format,
+        see page()). Ordered by id, or by (datetime, id) with order="datetime"
+        which leaves out events without a date"""
+        columns = select_fields(EVENT_COLUMNS, fields, ("event_id",))
+        stmt = select(*columns, Event.datetime.label("_datetime"))
+        if owner_id is not None:
+            stmt = stmt.filter(Event.ownerID == owner_id)
+        if date_from is not None:
+            stmt = stmt.filter(Event.datetime >= naive_utc(date_from))
+        if date_to is not None:
+            stmt = stmt.filter(Event.datetime < naive_utc(date_to))
+        if upcoming:
+            stmt = stmt.filter(Event.datetime >= datetime.utcnow())
+
+        after = decode_cursor(cursor) if cursor else None
+        if order == "datetime":
+            stmt = stmt.filter(Event.datetime.isnot(None))
+            if after is not None:
+                try:
+                    after = [datetime.fromisoformat(after[0]), *after[1:]]
+                except (TypeError, ValueError, IndexError):
+                    raise ValueError("Invalid cursor")
+            stmt = keyset(stmt, (Event.datetime, Event.id), after, limit)
+            cursor_of = lambda item: [item["_datetime"].isoformat(), item["event_id"]]
+        else:
+            stmt = keyset(stmt, (Event.id,), after, limit)
+            cursor_of = lambda item: [item["event_id"]]
+
+        async def load():
+            result = await session.execute(stmt)
+            return page(result.mappings(), limit, cursor_of)
+
+        key = (
+            "events",
+            limit,
+            cursor,
+            tuple(fields or ()),
+            owner_id,
+            date_from,
+            date_to,
+            upcoming,
+            order,
+        )
+        return await self._cached(key, load)
+
+    # region Allowlist
+    async def get_event_allowlist(
+        self,
+        session: AsyncSession,
+        event_id: int,
+        limit: int = 50,
+        cursor: str | None = None,
+    ) -> dict:
+        """One page of the VK ids on an event allowlist, see page()"""
+        stmt = keyset(
+            select(UserAllowlist.user_id.label("vk_id")).filter(
+                UserAllowlist.event_id == event_id
+            ),
+            (UserAllowlist.user_id,),
+            decode_cursor(cursor) if cursor else None,
+            limit,
+        )
+        result = await session.execute(stmt)
+        return page(result.mappings(), limit, lambda item: [item["vk_id"]])
+
+    async def is_allowed(self, session: AsyncSession, event_id: int, vk_id: int) -> bool:
+        """Whether a VK user is on an event allowlist. The whole list is
+        loaded once into a set in the read cache, later checks are O(1)"""
+
+        async def load():
+            result = await session.execute(allowlist_query(event_id))
+            return frozenset(result.scalars())
+
+        return vk_id in await self._cached(("allowlist", event_id), load)
+
+    def invalidate_allowlist(self, event_id: int) -> None:
+        """Drop the cached allowlist of an event, and the event that embeds it"""
+        self.invalidate("allowlist", event_id)
+
+    # endregion
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from os import getenv, makedirs, path
+
+
+class ImageCache:
+    """Content-addressed cache for processed ticket images.
+
+    Holds two kinds of entries:
+      source URL -> content hash (+ ETag / Last-Modified) of the last download
+      (content hash, transform parameters) -> uploaded Pictshare links
+    The memory tier is an LRU bounded by a byte budget, the optional disk
+    tier (IMAGE_CACHE_DIR) keeps one small JSON file per entry"""
+
+    def __init__(self, log):
+        self.log = log
+        self.max_bytes = int(getenv("IMAGE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+        # How long a source URL is trusted without downloading it again
+        self.source_ttl = float(getenv("IMAGE_CACHE_SOURCE_TTL", "600"))
+        self.directory = getenv("IMAGE_CACHE_DIR") or None
+        if self.directory:
+            makedirs(self.directory, exist_ok=True)
+        self._entries: OrderedDict[str, tuple[dict, int]] = OrderedDict()
+        self.size = 0
+
+    # region Keys
+    @staticmethod
+    def source_key(url: str) -> str:
+        return "source:" + url
+
+    @staticmethod
+    def upload_key(content_hash: str, params: str) -> str:
+        return f"upload:{content_hash}:{params}"
+
+    @staticmethod
+    def content_hash(data: bytes) -> str:
+        return sha256(data).hexdigest()
+
+    # endregion
+
+    # region Memory tier
+    def _get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _set(self, key: str, value: dict) -> None:
+        size = len(key) + len(json.dumps(value))
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes and self._entries:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    # endregion
+
+    # region Disk tier
+    def _disk_path(self, key: str) -> str:
+        return path.join(self.directory, sha256(key.encode()).hexdigest() + ".json")
+
+    def _disk_read(self, key: str) -> dict | None:
+        try:
+            with open(self._disk_path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.log.warning(f"Image cache entry {key} unreadable: {e!r}")
+            return None
+
+    def _disk_write(self, key: str, value: dict) -> None:
+        try:
+            with open(self._disk_path(key), "w") as f:
+                json.dump(value, f)
+        except OSError as e:
+            self.log.warning(f"Image cache entry {key} not written: {e!r}")
+
+    # endregion
+
+    async def get(self, key: str) -> dict | None:
+        value = self._get(key)
+        if value is None and self.directory:
+            value = await asyncio.to_thread(self._disk_read, key)
+            if value is not None:
+                self._set(key, value)
+        return value
+
+    async def set(self, key: str, value: dict) -> None:
+        self._set(key, value)
+        if self.directory:
+            await asyncio.to_thread(self._disk_write, key, value)
+
+    async def get_source(self, url: str, stale: bool = False) -> dict | None:
+        """{"hash", "etag", "last_modified", "fetched"} of a URL downloaded
+        less than source_ttl seconds ago, or at any time with `stale`"""
+        source = await self.get(self.source_key(url))
+        if source is None or (
+            not stale and time.time() - source["fetched"] > self.source_ttl
+        ):
+            return None
+        return source
+
+    async def set_source(self, url: str, content_hash: str, headers: dict) -> dict:
+        """Record a download. `headers` of a 304 response may omit the
+        validators, those of the same content are kept then"""
+        previous = await self.get(self.source_key(url)) or {}
+        if previous.get("hash") != content_hash:
+            previous = {}
+        source = {
+            "hash": content_hash,
+            "etag": headers.get("etag") or previous.get("etag"),
+            "last_modified": headers.get("last-modified")
+            or previous.get("last_modified"),
+            "fetched": time.time(),
+        }
+        await self.set(self.source_key(url), source)
+        return source
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import cpu_count, getenv
+
+import httpx
+
+from modules.imagecache import ImageCache
+from modules.imagetools import ImageTools
+from modules.metrics import observe_image_timings
+from modules.nftimage.nftimage import (
+    NFTImage,
+    ImageTooLarge,
+    timed,
+    encoder_settings,
+    decode_limits,
+)
+
+# Operations producing the blurred image, and the mint image on top of it
+BLUR_OPERATIONS = ["blur"]
+MINT_OPERATIONS = ["darken", "watermark"]
+
+# region Worker process side
+_nftimage: NFTImage | None = None
+
+
+def _get_nftimage() -> NFTImage:
+    """NFTImage instance local to the worker process"""
+    global _nftimage
+    if _nftimage is None:
+        _nftimage = NFTImage()
+    return _nftimage
+
+
+def render_ticket(
+    orig_img_b: bytes,
+    encoder: dict | None = None,
+    limits: tuple[int, int] | None = None,
+) -> tuple[bytes, bytes, dict]:
+    """Returns (blurred image, mint image, {step: seconds}). The source is
+    decoded once, the blur is computed once and reused as the base of the
+    darkened, watermarked mint image; each output is encoded once, with
+    `encoder` (see encoder_settings) or the worker's own settings.
+    `limits` are (max side, max pixels) of the decode, see decode_limits.
+    Timings go back to the parent process, which records the metrics"""
+    nftimage = _get_nftimage()
+    timings = {}
+    with timed(timings, "decode"):
+        orig = nftimage.decode(orig_img_b, *(limits or decode_limits()))
+        orig.load()
+    blurred = nftimage.apply(orig, BLUR_OPERATIONS, timings)
+    minted = nftimage.apply(blurred, MINT_OPERATIONS, timings)
+    with timed(timings, "encode"):
+        encoder = encoder or {}
+        blur_img_b = nftimage.encode(blurred, **encoder)
+        mint_img_b = nftimage.encode(minted, **encoder)
+    return blur_img_b, mint_img_b, timings
+
+
+# endregion
+
+
+class ImagePipeline:
+    """Ticket image pipeline: download, Pillow work in a process pool,
+    parallel streaming uploads. Nothing here blocks the event loop.
+    Results are cached by content (see ImageCache) and concurrent requests
+    for the same image share one download, transform and upload"""
+
+    def __init__(self, log, itools: ImageTools):
+        self.log = log
+        self.itools = itools
+        self.workers = int(getenv("IMAGE_WORKERS", str(cpu_count() or 1)))
+        self.fetch_timeout = float(getenv("IMAGE_FETCH_TIMEOUT", "15"))
+        self.max_bytes = int(getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+        self.limits = decode_limits()
+        # Passed to the workers, so renders always match the cache key
+        self.encoder = encoder_settings()
+        # Identifies the transform in image cache keys
+        self.transform_key = (
+            f"{BLUR_OPERATIONS}{MINT_OPERATIONS}"
+            f"{self.encoder['format']}:{self.encoder['compress_level']}:"
+            f"{self.encoder['quality']}:{self.limits[0]}"
+        )
+        self._executor: ProcessPoolExecutor | None = None
+        self._client: httpx.AsyncClient | None = None
+        self.cache = ImageCache(log)
+        self._inflight: dict[tuple, asyncio.Future] = {}
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # Created lazily so importing the API does not fork
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _reset_executor(self, broken: ProcessPoolExecutor) -> None:
+        # Concurrent renders all fail on the same pool, only the first
+        # one replaces it
+        if self._executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.fetch_timeout, follow_redirects=True
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+        await self.itools.aclose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def fetch(
+        self, url: str, source: dict | None = None
+    ) -> tuple[bytes | None, dict]:
+        """Download the source image, returns (content, response headers).
+        The body is streamed and abandoned past IMAGE_MAX_BYTES. With the
+        `source` entry of an earlier download the request is conditional,
+        content is None when the image did not change (304)"""
+        headers = {}
+        if source is not None:
+            if source.get("etag"):
+                headers["If-None-Match"] = source["etag"]
+            if source.get("last_modified"):
+                headers["If-Modified-Since"] = source["last_modified"]
+        async with self.client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and source is not None:
+                return None, dict(response.headers)
+            response.raise_for_status()
+            length = response.headers.get("content-length")
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                raise ImageTooLarge(f"{url} is {length} bytes")
+            content = bytearray()
+            async for chunk in response.aiter_bytes():
+                content += chunk
+                if len(content) > self.max_bytes:
+                    raise ImageTooLarge(f"{url} is over {self.max_bytes} bytes")
+            return bytes(content), dict(response.headers)
+
+    async def render(self, orig_img_b: bytes) -> tuple[bytes, bytes]:
+        """(blurred, mint) image bytes, computed in the process pool"""
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            blur_img_b, mint_img_b, timings = await loop.run_in_executor(
+                executor, render_ticket, orig_img_b, self.encoder, self.limits
+            )
+        except BrokenProcessPool:
+            # A worker died (OOM kill, segfault) and the pool refuses all
+            # work from then on: replace it and retry once
+            self.log.warning("Image process pool broken, restarting it")
+            self._reset_executor(executor)
+            blur_img_b, mint_img_b, timings = await loop.run_in_executor(
+                self.executor, render_ticket, orig_img_b, self.encoder, self.limits
+            )
+        observe_image_timings(timings)
+        return blur_img_b, mint_img_b
+
+    async def upload(self, *images: bytes) -> list[str]:
+        """Upload several images at the same time, returns their links"""
+        return await self.itools.upload_many(list(images))
+
+    async def _once(self, key: tuple, func, *args):
+        """Run func(*args) once for all concurrent callers with the same key"""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def process(self, url: str) -> tuple[str, str]:
+        """Full pipeline for a ticket image, returns (mint url, blurred url)"""
+        return await self._once(("url", url), self._process_url, url)
+
+    async def _process_url(self, url: str) -> tuple[str, str]:
+        orig_img_b = None
+        source = await self.cache.get_source(url)
+        if source is None:
+            # Revalidate an expired entry instead of downloading it again
+            stale = await self.cache.get_source(url, stale=True)
+            orig_img_b, headers = await self.fetch(url, stale)
+            if orig_img_b is None:
+                source = await self.cache.set_source(url, stale["hash"], headers)
+            else:
+                source = await self.cache.set_source(
+                    url, self.cache.content_hash(orig_img_b), headers
+                )
+        key = self.cache.upload_key(source["hash"], self.transform_key)
+        return await self._once(
+            ("upload", key), self._render_upload, key, url, orig_img_b
+        )
+
+    async def _render_upload(
+        self, key: str, url: str, orig_img_b: bytes | None
+    ) -> tuple[str, str]:
+        cached = await self.cache.get(key)
+        if cached is not None:
+            return cached["mint"], cached["blur"]
+        if orig_img_b is None:
+            # The source is known but its uploads were evicted
+            orig_img_b, _ = await self.fetch(url)
+        blur_img_b, mint_img_b = await self.render(orig_img_b)
+        blur_img, mint_img = await self.upload(blur_img_b, mint_img_b)
+        await self.cache.set(key, {"mint": mint_img, "blur": blur_img})
+        return mint_img, blur_img
@@ -1,13 +1,112 @@
+import asyncio
+from os import PathLike, getenv
+from pathlib import Path
+from typing import BinaryIO
+
+import httpx
 import requests as r
-import json
+
+from modules.metrics import track_upstream
+
+# Anything upload() accepts: bytes, an open binary file or a path
+ImageSource = bytes | BinaryIO | str | PathLike
+
+
+class UploadError(Exception):
+    """Pictshare refused or failed the upload"""
+
 
 class ImageTools:
     def __init__(self, url):
         self.url = url if url[-1] == "/" else url + "/"
+        self.endpoint = self.url + "api/upload.php"
+        self.timeout = httpx.Timeout(
+            float(getenv("PICTSHARE_TIMEOUT", "30")),
+            connect=float(getenv("PICTSHARE_CONNECT_TIMEOUT", "5")),
+        )
+        self.concurrency = int(getenv("PICTSHARE_CONCURRENCY", "8"))
+        self.retries = int(getenv("PICTSHARE_RETRIES", "3"))
+        self.backoff = float(getenv("PICTSHARE_BACKOFF", "0.5"))
+        self._session: r.Session | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    @staticmethod
+    def _parse(body: dict) -> str:
+        if body.get("status") == "err" or "url" not in body:
+            raise UploadError(body.get("reason", body))
+        return body["url"]
 
     def upload(self, image: bytes) -> str:
         """Uploads image to self.url and returns a link"""
-        endpoint = self.url + "api/upload.php"
+        if self._session is None:
+            self._session = r.Session()
         # POST file to endpoint
-        response = r.post(endpoint, files={"file": image})
-        return json.loads(response.text)["url"]
+        response = self._session.post(
+            self.endpoint, files={"file": image}, timeout=self.timeout.read
+        )
+        response.raise_for_status()
+        return self._parse(response.json())
+
+    # region Async client
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Keep-alive client, created lazily inside the running event loop"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.concurrency,
+                    max_keepalive_connections=self.concurrency,
+                ),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def upload_async(self, image: ImageSource, filename: str = "image") -> str:
+        """Uploads image without blocking the event loop and returns a link.
+        Files and paths are streamed into the multipart body rather than read
+        into memory. Retries with exponential backoff on connection errors,
+        timeouts and 429/5xx responses"""
+        async with self._semaphore:
+            if isinstance(image, (str, PathLike)):
+                path = Path(image)
+                with path.open("rb") as file:
+                    return await self._post(file, path.name)
+            return await self._post(image, filename)
+
+    async def upload_many(self, images: list[ImageSource]) -> list[str]:
+        """Uploads images in parallel (at most PICTSHARE_CONCURRENCY at a time),
+        returns their links in the same order"""
+        return list(await asyncio.gather(*(self.upload_async(i) for i in images)))
+
+    async def _post(self, image: bytes | BinaryIO, filename: str) -> str:
+        with track_upstream("pictshare", "upload"):
+            return await self._post_retrying(image, filename)
+
+    async def _post_retrying(self, image: bytes | BinaryIO, filename: str) -> str:
+        start = None if isinstance(image, bytes) else image.tell()
+        attempt = 0
+        while True:
+            if start is not None:
+                image.seek(start)
+            try:
+                response = await self.client.post(
+                    self.endpoint, files={"file": (filename, image)}
+                )
+                response.raise_for_status()
+                return self._parse(response.json())
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                retryable = isinstance(e, httpx.TransportError) or (
+                    e.response.status_code == 429 or e.response.status_code >= 500
+                )
+                if attempt >= self.retries or not retryable:
+                    raise
+                await asyncio.sleep(self.backoff * 2**attempt)
+                attempt += 1
+
+    # endregion
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import asyncio
+from datetime import datetime, timedelta
+from os import getenv
+from typing import Awaitable, Callable
+
+from modules.db import AsyncDBManager
+from modules.models import Job
+
+# handler(payload, progress) -> JSON-serializable result. `progress` is a
+# dict the handler may update, it is saved with every lease renewal
+Handler = Callable[[dict, dict], Awaitable]
+
+
+class JobQueue:
+    """Durable job queue on the `jobs` table.
+    API processes enqueue(); workers start() the registered handlers. Every
+    job type has its own poll loop and concurrency limit, jobs are leased with
+    FOR UPDATE SKIP LOCKED so any number of workers can share the table, and
+    failed attempts are retried with exponential backoff. A ValueError means
+    invalid input and fails the job right away"""
+
+    def __init__(self, log, adb: AsyncDBManager):
+        self.log = log
+        self.adb = adb
+        self.max_attempts = int(getenv("JOB_MAX_ATTEMPTS", "3"))
+        self.backoff = float(getenv("JOB_BACKOFF", "10"))
+        self.max_backoff = float(getenv("JOB_MAX_BACKOFF", "600"))
+        self.lease = float(getenv("JOB_LEASE", "60"))
+        self.poll_interval = float(getenv("JOB_POLL_INTERVAL", "5"))
+        self.handlers: dict[str, tuple[Handler, int]] = {}
+        self._wakeup: dict[str, asyncio.Event] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def register(self, job_type: str, handler: Handler, concurrency: int = 1) -> None:
+        """Run `job_type` jobs with `handler`, at most `concurrency` at a time
+        per worker (JOB_CONCURRENCY_<TYPE> overrides it)"""
+        concurrency = int(getenv(f"JOB_CONCURRENCY_{job_type.upper()}", concurrency))
+        self.handlers[job_type] = (handler, concurrency)
+
+    async def enqueue(
+        self, job_type: str, payload: dict, max_attempts: int | None = None
+    ) -> str:
+        """Store a job and return its id"""
+        async with self.adb.sessionmaker() as session:
+            job_id = await self.adb.enqueue_job(
+                session, job_type, payload, max_attempts or self.max_attempts
+            )
+        if job_type in self._wakeup:
+            self._wakeup[job_type].set()
+        return job_id
+
+    async def wait(self, job_id: str, timeout: float) -> dict | None:
+        """Poll a job until it is done or failed, for at most `timeout`
+        seconds. Returns it (see AsyncDBManager.get_job), None when it is
+        still queued or running by then"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = 0.05
+        while True:
+            async with self.adb.sessionmaker() as session:
+                job = await self.adb.get_job(session, job_id)
+            if job is not None and job["status"] in ("done", "failed"):
+                return job
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+
+    # region Lifecycle
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._run(job_type)) for job_type in self.handlers
+            ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # endregion
+
+    def _retry_delay(self, attempts: int) -> float:
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+    async def _run(self, job_type: str) -> None:
+        handler, concurrency = self.handlers[job_type]
+        wakeup = self._wakeup.setdefault(job_type, asyncio.Event())
+        running: set[asyncio.Task] = set()
+        try:
+            while True:
+                wakeup.clear()
+                delay = self.poll_interval
+                try:
+                    free = concurrency - len(running)
+                    if free > 0:
+                        async with self.adb.sessionmaker() as session:
+                            jobs = await self.adb.claim_jobs(
+                                session, job_type, free, self.lease
+                            )
+                        for job in jobs:
+                            task = asyncio.create_task(self._execute(handler, job))
+                            running.add(task)
+                            task.add_done_callback(running.discard)
+                            # A free slot, look for more work
+                            task.add_done_callback(lambda _: wakeup.set())
+                        if len(jobs) < free:
+                            # Nothing else is due now, sleep until the next one
+                            async with self.adb.sessionmaker() as session:
+                                next_run = await self.adb.next_job_run(
+                                    session, [job_type]
+                                )
+                            if next_run is not None:
+                                due = (next_run - datetime.utcnow()).total_seconds()
+                                delay = min(max(due, 0.1), self.poll_interval)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.log.exception(f"{job_type} job loop iteration failed")
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # Interrupted jobs are picked up again once their lease expires
+            for task in running:
+                task.cancel()
+
+    async def _execute(self, handler: Handler, job: Job) -> None:
+        progress = dict(job.progress or {})
+        if job.attempts > job.maxAttempts:
+            # Leased too often: its workers died while running it
+            await self._finish(job, "failed", progress, error="Worker lost")
+            return
+        work = asyncio.ensure_future(handler(job.payload, progress))
+        renewal = asyncio.create_task(self._renew(job, progress, work))
+        try:
+            result = await work
+        except asyncio.CancelledError:
+            if renewal.done() and not renewal.cancelled():
+                return  # Lease lost, the attempt that took over records the outcome
+            raise
+        except Exception as e:
+            error = repr(e)
+            if job.attempts < job.maxAttempts and not isinstance(e, ValueError):
+                delay = self._retry_delay(job.attempts)
+                self.log.warning(
+                    f"{job.type} job {job.id} attempt {job.attempts} failed,"
+                    f" retrying in {delay:.0f}s: {error}"
+                )
+                await self._finish(
+                    job,
+                    "queued",
+                    progress,
+                    error=error,
+                    retry_at=datetime.utcnow() + timedelta(seconds=delay),
+                )
+            else:
+                self.log.error(f"{job.type} job {job.id} failed: {error}")
+                await self._finish(job, "failed", progress, error=error)
+        else:
+            await self._finish(job, "done", progress, result=result)
+        finally:
+            renewal.cancel()
+
+    async def _renew(self, job: Job, progress: dict, work: asyncio.Future) -> None:
+        """Keep the lease of a running job and save its progress. Stops the
+        handler (`work`) once another worker has taken the job over"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with self.adb.sessionmaker() as session:
+                    renewed = await self.adb.renew_job(
+                        session, job.id, job.attempts, self.lease, dict(progress)
+                    )
+            except Exception:
+                self.log.exception(f"Could not renew the lease of job {job.id}")
+                continue
+            if not renewed:
+                self.log.warning(
+                    f"{job.type} job {job.id} attempt {job.attempts} lost its lease,"
+                    " stopping it"
+                )
+                work.cancel()
+                return
+
+    async def _finish(self, job: Job, status: str, progress: dict, **outcome) -> None:
+        async with self.adb.sessionmaker() as session:
+            finished = await self.adb.finish_job(
+                session, job.id, job.attempts, status, dict(progress) or None, **outcome
+            )
+        if not finished:
+            self.log.warning(
+                f"{job.type} job {job.id} attempt {job.attempts} lost its lease,"
+                f" its {status} outcome was dropped"
+            )
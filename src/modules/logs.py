@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import json
+import logging
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from os import getenv
+
+# Attributes of every LogRecord, anything else was passed with `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def truncate(text: str, max_length: int) -> str:
+    if max_length and len(text) > max_length:
+        return f"{text[:max_length]}... ({len(text) - max_length} more chars)"
+    return text
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, exception
+    and the `extra=` fields of the call"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=repr)
+
+
+class NonBlockingHandler(QueueHandler):
+    """Hands records to a QueueListener thread, the caller only pays for
+    building the message. Messages are cut at `max_length` chars and
+    records below WARNING are kept with probability `sample_rate`.
+    When the queue is full records are dropped rather than waited for"""
+
+    def __init__(self, records, max_length: int = 2000, sample_rate: float = 1.0):
+        super().__init__(records)
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.levelno < logging.WARNING and random.random() >= self.sample_rate:
+            return
+        super().emit(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Same as QueueHandler.prepare, minus the formatting: only the
+        # (truncated) message and the exception text cross the queue
+        record = logging.makeLogRecord(vars(record))
+        record.msg = truncate(record.getMessage(), self.max_length)
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+
+def setup_logging(log: logging.Logger, logfile: str, level: str) -> QueueListener:
+    """Console and rotating file output for `log`, written by a listener
+    thread. Returns the started listener, stop() it on shutdown to flush"""
+    json_formatter = JSONFormatter()
+    console = logging.StreamHandler()
+    if getenv("LOG_FORMAT", "json").lower() == "json":
+        console.setFormatter(json_formatter)
+    else:
+        console.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+    file = RotatingFileHandler(
+        logfile,
+        maxBytes=int(getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+        backupCount=int(getenv("LOG_BACKUPS", "5")),
+        encoding="utf-8",
+    )
+    file.setFormatter(json_formatter)
+
+    records = queue.Queue(int(getenv("LOG_QUEUE_SIZE", "10000")))
+    listener = QueueListener(records, console, file, respect_handler_level=True)
+    log.addHandler(
+        NonBlockingHandler(
+            records,
+            max_length=int(getenv("LOG_MAX_MESSAGE", "2000")),
+            sample_rate=float(getenv("LOG_SAMPLE_RATE", "1")),
+        )
+    )
+    log.setLevel(getattr(logging, level.upper(), logging.INFO))
+    log.propagate = False
+    listener.start()
+    return listener
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import time
+from contextvars import ContextVar
+from os import getenv
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+
+# region Metrics
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests being served",
+    multiprocess_mode="livesum",
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Duration of single database statements",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request",
+    "Database statements executed while serving a request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+DB_TIME_PER_REQUEST = Histogram(
+    "db_time_per_request_seconds",
+    "Time spent in database statements while serving a request",
+    ["route"],
+)
+UPSTREAM_DURATION = Histogram(
+    "upstream_request_duration_seconds",
+    "Latency of calls to external services",
+    ["service", "operation"],
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_errors_total",
+    "Failed calls to external services",
+    ["service", "operation"],
+)
+IMAGE_TRANSFORM_DURATION = Histogram(
+    "image_transform_duration_seconds",
+    "NFTImage decode, operation and encode timings",
+    ["step"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+# endregion
+
+# {"queries", "seconds"} of the request being served, None outside requests
+_db_stats: ContextVar[dict | None] = ContextVar("db_stats", default=None)
+
+
+# region Database
+def instrument_engine(engine) -> None:
+    """Time every statement of a (sync) engine, for AsyncEngine pass
+    engine.sync_engine. The statements also count towards the current request"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_DURATION.observe(elapsed)
+        stats = _db_stats.get()
+        if stats is not None:
+            stats["queries"] += 1
+            stats["seconds"] += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+
+# endregion
+
+
+# region Upstream calls
+class track_upstream:
+    """Context manager timing a call to `service`, failures (exceptions, or
+    failed() for error responses) are counted as errors"""
+
+    def __init__(self, service: str, operation: str):
+        self.service = service
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        UPSTREAM_DURATION.labels(self.service, self.operation).observe(
+            time.perf_counter() - self.start
+        )
+        if exc_type is not None:
+            self.failed()
+
+    def failed(self) -> None:
+        UPSTREAM_ERRORS.labels(self.service, self.operation).inc()
+
+
+# endregion
+
+
+def observe_image_timings(timings: dict) -> None:
+    """Record {step: seconds} measured by NFTImage (possibly in a worker process)"""
+    for step, seconds in timings.items():
+        IMAGE_TRANSFORM_DURATION.labels(step).observe(seconds)
+
+
+# region HTTP
+class MetricsMiddleware:
+    """ASGI middleware: latency by route template, in-flight requests and
+    the database work of every request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = {"queries": 0, "seconds": 0.0}
+        token = _db_stats.set(stats)
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            _db_stats.reset(token)
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            HTTP_REQUEST_DURATION.labels(scope["method"], route, status).observe(
+                time.perf_counter() - start
+            )
+            DB_QUERIES_PER_REQUEST.labels(route).observe(stats["queries"])
+            DB_TIME_PER_REQUEST.labels(route).observe(stats["seconds"])
+
+
+def render() -> tuple[bytes, str]:
+    """(body, content type) of the Prometheus exposition. With several API
+    workers set PROMETHEUS_MULTIPROC_DIR to aggregate all of them"""
+    if getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# endregion
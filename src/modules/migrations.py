@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from modules.models import Base
+
+# region Migrations
+# Allowlist entries (users.id) of users without a VK id, migration 2 drops them
+UNMAPPED_ALLOWLISTS = """
+SELECT event_id, user_id FROM user_allowlists
+WHERE event_id IS NOT NULL AND NOT EXISTS (
+    SELECT 1 FROM users
+    WHERE users.id = user_allowlists.user_id AND users.vk_id IS NOT NULL
+)
+UNION ALL
+SELECT events.id, item.user_id
+FROM events CROSS JOIN unnest(events."allowList") AS item(user_id)
+WHERE NOT EXISTS (
+    SELECT 1 FROM users WHERE users.id = item.user_id AND users.vk_id IS NOT NULL
+)
+"""
+
+
+# The baseline primary key of user_allowlists is user_id alone. Dropped only
+# in that layout, the (event_id, user_id) key of the models is kept
+DROP_LEGACY_ALLOWLIST_PKEY = """
+DO $$
+DECLARE legacy name;
+BEGIN
+    SELECT conname INTO legacy FROM pg_constraint
+    WHERE conrelid = 'user_allowlists'::regclass AND contype = 'p'
+    AND NOT EXISTS (
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = conrelid AND attnum = ANY (conkey)
+        AND attname = 'event_id'
+    );
+    IF legacy IS NOT NULL THEN
+        EXECUTE format('ALTER TABLE user_allowlists DROP CONSTRAINT %I', legacy);
+    END IF;
+END $$
+"""
+
+
+def report_unmapped_allowlists(conn, log) -> None:
+    rows = conn.execute(text(UNMAPPED_ALLOWLISTS)).all()
+    if rows:
+        log.warning(
+            f"Dropping {len(rows)} allowlist entries of unknown users or users"
+            f" without a VK id (event_id, users.id): {[tuple(row) for row in rows]}"
+        )
+
+
+# create_all() creates tables that do not exist yet, with everything the
+# models declare. Migrations bring existing tables up to date, so every
+# statement has to be a no-op on a freshly created schema (IF NOT EXISTS...).
+# Statements are SQL strings, or callables(conn, log) for steps that report.
+# Append new migrations at the end, never edit applied ones.
+MIGRATIONS = [
+    (
+        1,
+        "Indexes on hot lookup columns, unique users.vk_id",
+        [
+            # Merge duplicate users (racing logins) into the oldest row:
+            # repoint everything that references users.id, then delete them
+            """
+            UPDATE events SET "ownerID" = dup.keep
+            FROM (
+                SELECT id, min(id) OVER (PARTITION BY vk_id) AS keep
+                FROM users WHERE vk_id IS NOT NULL
+            ) AS dup
+            WHERE events."ownerID" = dup.id AND dup.id <> dup.keep
+            """,
+            """
+            UPDATE events SET "allowList" = ARRAY(
+                SELECT coalesce(dup.keep, item.user_id)
+                FROM unnest(events."allowList") WITH ORDINALITY AS item(user_id, n)
+                LEFT JOIN (
+                    SELECT id, min(id) OVER (PARTITION BY vk_id) AS keep
+                    FROM users WHERE vk_id IS NOT NULL
+                ) AS dup ON dup.id = item.user_id
+                ORDER BY item.n
+            )
+            WHERE "allowList" IS NOT NULL
+            """,
+            # Two merged users may both be listed, which the legacy key
+            # refuses. Migration 2 adds the (event_id, user_id) key
+            DROP_LEGACY_ALLOWLIST_PKEY,
+            """
+            UPDATE user_allowlists SET user_id = dup.keep
+            FROM (
+                SELECT id, min(id) OVER (PARTITION BY vk_id) AS keep
+                FROM users WHERE vk_id IS NOT NULL
+            ) AS dup
+            WHERE user_allowlists.user_id = dup.id AND dup.id <> dup.keep
+            """,
+            """
+            DELETE FROM users USING users AS kept
+            WHERE users.vk_id = kept.vk_id AND users.id > kept.id
+            """,
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_vk_id ON users (vk_id)",
+            'CREATE INDEX IF NOT EXISTS "ix_events_ownerID" ON events ("ownerID")',
+            'CREATE INDEX IF NOT EXISTS "ix_nfts_eventId" ON nfts ("eventId")',
+            "CREATE INDEX IF NOT EXISTS ix_user_allowlists_event_id ON user_allowlists (event_id)",
+            "CREATE INDEX IF NOT EXISTS ix_mints_status ON mints (status)",
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS ix_mints_nft_wallet
+            ON mints ("nftId", wallet) WHERE status <> 'failed'
+            """,
+        ],
+    ),
+    (
+        2,
+        "Allowlists keyed by (event_id, user_id) VK ids, events.allowList moved",
+        [
+            DROP_LEGACY_ALLOWLIST_PKEY,
+            "DELETE FROM user_allowlists WHERE event_id IS NULL",
+            # user_id and events."allowList" hold users.id, the key is the VK
+            # id now. Entries that cannot be mapped are logged and dropped
+            # first, so every remaining one is converted
+            report_unmapped_allowlists,
+            """
+            DELETE FROM user_allowlists
+            WHERE NOT EXISTS (
+                SELECT 1 FROM users
+                WHERE users.id = user_allowlists.user_id AND users.vk_id IS NOT NULL
+            )
+            """,
+            """
+            UPDATE user_allowlists SET user_id = users.vk_id
+            FROM users WHERE users.id = user_allowlists.user_id
+            """,
+            """
+            INSERT INTO user_allowlists (event_id, user_id)
+            SELECT events.id, users.vk_id
+            FROM events CROSS JOIN unnest(events."allowList") AS item(user_id)
+            JOIN users ON users.id = item.user_id
+            WHERE users.vk_id IS NOT NULL
+            """,
+            """
+            DELETE FROM user_allowlists AS a USING user_allowlists AS b
+            WHERE a.event_id = b.event_id AND a.user_id = b.user_id
+            AND a.ctid < b.ctid
+            """,
+            "ALTER TABLE user_allowlists ALTER COLUMN event_id SET NOT NULL",
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conrelid = 'user_allowlists'::regclass AND contype = 'p'
+                ) THEN
+                    ALTER TABLE user_allowlists ADD PRIMARY KEY (event_id, user_id);
+                END IF;
+            END $$
+            """,
+            # Covered by the primary key
+            "DROP INDEX IF EXISTS ix_user_allowlists_event_id",
+        ],
+    ),
+]
+# endregion
+
+# Any number, identifies the migration lock among advisory locks
+LOCK_ID = 7_306_001
+
+
+class Migrator:
+    """Applies MIGRATIONS in order and records them in schema_migrations"""
+
+    def __init__(self, log, engine):
+        self.log = log
+        self.engine = engine
+
+    def migrate(self) -> None:
+        with self.engine.begin() as conn:
+            # Several API workers may start at once
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": LOCK_ID})
+            Base.metadata.create_all(conn)
+            conn.execute(
+                text(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        description VARCHAR(200),
+                        applied_at TIMESTAMP
+                    )
+                    """
+                )
+            )
+            applied = set(
+                conn.execute(text("SELECT version FROM schema_migrations")).scalars()
+            )
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                self.log.warning(f"Applying migration {version}: {description}")
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn, self.log)
+                    else:
+                        conn.execute(text(statement))
+                conn.execute(
+                    text(
+                        "INSERT INTO schema_migrations (version, description, applied_at)"
+                        " VALUES (:version, :description, :applied_at)"
+                    ),
+                    {
+                        "version": version,
+                        "description": description,
+                        "applied_at": datetime.utcnow(),
+                    },
+                )
+
+    def verify(self) -> list[str]:
+        """Names of indexes declared on the models but missing in the database"""
+        inspector = inspect(self.engine)
+        missing = []
+        for table in Base.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            existing |= {
+                constraint["name"]
+                for constraint in inspector.get_unique_constraints(table.name)
+            }
+            for index in table.indexes:
+                if index.name not in existing:
+                    missing.append(f"{table.name}.{index.name}")
+        for name in missing:
+            self.log.error(f"Missing index {name}, run the migrations")
+        return missing
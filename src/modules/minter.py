@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import time
+from os import getenv
+
+from modules import contracts
+from modules.db import AsyncDBManager
+from modules.reconciler import MintReconciler
+
+
+class RateLimiter:
+    """Token bucket: at most `rate` acquisitions per second, bursts up to `burst`"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Minter:
+    """Mints an NFT to one or many users (airdrop).
+    Recipients, wallets and the collection are looked up with a few set-based
+    queries, every (NFT, wallet) pair is reserved in the `mints` table right
+    before its chunk is minted so duplicates are skipped, and cm_mintNFT calls
+    go through a concurrency- and rate-limited worker pool. Accepted mints are
+    left to the reconciler"""
+
+    def __init__(self, log, adb: AsyncDBManager, reconciler: MintReconciler):
+        self.log = log
+        self.adb = adb
+        self.reconciler = reconciler
+        self.concurrency = int(getenv("MINT_CONCURRENCY", "8"))
+        self.chunk_size = int(getenv("MINT_CHUNK_SIZE", "50"))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._limiter = RateLimiter(
+            float(getenv("MINT_RATE", "5")), burst=self.concurrency
+        )
+
+    async def mint(
+        self, nft_id: int, recipients: list[int] | None = None, progress: dict = None
+    ) -> list[dict]:
+        """Mint `nft_id` to the VK users in `recipients` (the event allowlist by
+        default). Returns one {"vk_id", "status", ...} per recipient, status is
+        pending (accepted, see the reconciler), skipped (minted or being minted),
+        no_wallet or failed"""
+        progress = {} if progress is None else progress
+        async with self.adb.sessionmaker() as session:
+            context = await self.adb.get_mint_context(session, nft_id)
+            if context is None:
+                raise ValueError(f"NFT {nft_id} not found")
+            db_nft, collection_id, allowlist = context
+            if recipients is None:
+                recipients = list(allowlist or [])
+            recipients = list(dict.fromkeys(recipients))
+            wallets = await self.adb.get_wallets(session, recipients)
+
+        progress.update(total=len(recipients), done=0, pending=0, failed=0)
+        results = {}
+        todo = []
+        for vk_id in recipients:
+            wallet = wallets.get(vk_id)
+            if not wallet:
+                results[vk_id] = {"vk_id": vk_id, "status": "no_wallet"}
+            else:
+                todo.append((vk_id, wallet))
+        progress["done"] = len(results)
+
+        attributes = json.loads(db_nft.properties or "{}")
+        for offset in range(0, len(todo), self.chunk_size):
+            chunk = todo[offset : offset + self.chunk_size]
+            # Reserved right before the calls, so rows only stay "minting"
+            # while this chunk is in flight
+            async with self.adb.sessionmaker() as session:
+                reserved = await self.adb.reserve_mints(
+                    session,
+                    nft_id,
+                    collection_id,
+                    list(dict.fromkeys(wallet for _, wallet in chunk)),
+                )
+            calls = []
+            for vk_id, wallet in chunk:
+                if wallet in reserved:
+                    calls.append((vk_id, wallet, reserved.pop(wallet)))
+                else:
+                    results[vk_id] = {
+                        "vk_id": vk_id,
+                        "wallet": wallet,
+                        "status": "skipped",
+                    }
+            responses = await asyncio.gather(
+                *(
+                    self._mint_one(db_nft, collection_id, wallet, attributes)
+                    for _, wallet, _ in calls
+                )
+            )
+            rows = []
+            for (vk_id, wallet, mint_row), response in zip(calls, responses):
+                if isinstance(response, dict) and "id" in response:
+                    result = {
+                        "vk_id": vk_id,
+                        "wallet": wallet,
+                        "status": "pending",
+                        "mint_id": response["id"],
+                    }
+                    progress["pending"] += 1
+                else:
+                    result = {
+                        "vk_id": vk_id,
+                        "wallet": wallet,
+                        "status": "failed",
+                        "error": str(response),
+                    }
+                    progress["failed"] += 1
+                rows.append(
+                    {
+                        "b_id": mint_row,
+                        "b_mint_id": result.get("mint_id"),
+                        "b_status": result["status"],
+                    }
+                )
+                results[vk_id] = result
+            async with self.adb.sessionmaker() as session:
+                await self.adb.save_mint_requests(session, rows)
+            self.reconciler.wake()
+            progress["done"] += len(chunk)
+        return [results[vk_id] for vk_id in recipients]
+
+    async def _mint_one(self, db_nft, collection_id: str, wallet: str, attributes):
+        async with self._semaphore:
+            await self._limiter.acquire()
+            try:
+                return await contracts.mint_nft(
+                    collection_id,
+                    db_nft.title,
+                    db_nft.description,
+                    db_nft.mintImage,
+                    wallet,
+                    attributes,
+                )
+            except Exception as e:
+                self.log.error(f"cm_mintNFT for {wallet} failed: {e!r}")
+                return {"error": repr(e)}
@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, ARRAY
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, ARRAY, Index
+from sqlalchemy import Text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import declarative_base, relationship
@@ -11,7 +13,7 @@ class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
-    vk_id = Column(Integer)
+    vk_id = Column(Integer, unique=True, index=True)
     wallet_public_key = Column(String(44))
     first_name = Column(String(50))
     last_name = Column(String(50))
@@ -29,8 +31,9 @@ class Event(Base):
     tickets = Column(ARRAY(Integer))
     collectionID = Column(String)
     place = Column(String(150))
-    ownerID = Column(Integer, ForeignKey("users.id"))
-    # allowList is a list of user IDs
+    ownerID = Column(Integer, ForeignKey("users.id"), index=True)
+    # allowList is a list of user IDs. Superseded by user_allowlists
+    # (migration 2 copies it there as VK ids), no longer read
     allowList = Column(ARRAY(Integer))
 
     user_allowlist = relationship("UserAllowlist", backref="events")
@@ -38,10 +41,13 @@ class Event(Base):
 
 
 class UserAllowlist(Base):
+    """VK users allowed to an event, they need not have logged in yet.
+    The (event_id, user_id) key serves listing and membership lookups"""
+
     __tablename__ = "user_allowlists"
 
-    user_id = Column(Integer, primary_key=True)
-    event_id = Column(Integer, ForeignKey("events.id"))
+    event_id = Column(Integer, ForeignKey("events.id"), primary_key=True)
+    user_id = Column(Integer, primary_key=True)  # VK ID
 
 
 class NFT(Base):
@@ -57,10 +63,71 @@ class NFT(Base):
     properties = Column(String(500))
     mintHash = Column(String(70), default="")
     imageKey = Column(String(20))
-    eventId = Column(Integer, ForeignKey("events.id"))
+    eventId = Column(Integer, ForeignKey("events.id"), index=True)
+
+
+class Mint(Base):
+    """A cm_mintNFT request tracked by the reconciler until it settles"""
+
+    __tablename__ = "mints"
+    __table_args__ = (
+        # One live mint per (NFT, wallet), failed ones may be retried
+        Index(
+            "ix_mints_nft_wallet",
+            "nftId",
+            "wallet",
+            unique=True,
+            postgresql_where="status <> 'failed'",
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    nftId = Column(Integer, ForeignKey("nfts.id"))
+    wallet = Column(String(44))
+    mintId = Column(String(100))  # NFT id returned by Quiknode
+    collectionID = Column(String)
+    # minting (reserved, cm_mintNFT not answered yet), pending, success or failed
+    status = Column(String(20), default="pending", index=True)
+    mintHash = Column(String(70), default="")
+    attempts = Column(Integer, default=0)
+    nextCheck = Column(DateTime, server_default=func.now())
+    created = Column(DateTime, server_default=func.now())
+
+
+class RevokedToken(Base):
+    """Logged out access token (by sha256) -> user, until the token expires.
+    Shared by all API workers"""
+
+    __tablename__ = "revoked_tokens"
+
+    token = Column(String(64), primary_key=True)
+    user_id = Column(Integer)
+    expires = Column(DateTime, index=True)
 
 
 # class Token(Model):
 #     id = fields.IntField(pk=True)
 #     login_token = fields.CharField(max_length=2048)
 #     is_used = fields.BooleanField(default=False)
+
+
+class Job(Base):
+    """Durable background job, claimed by workers with FOR UPDATE SKIP LOCKED"""
+
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_due", "type", "status", "runAt"),)
+
+    id = Column(String(32), primary_key=True)  # uuid4 hex
+    type = Column(String(50))
+    payload = Column(JSONB)
+    # queued, running (leased until lockedUntil), done or failed
+    status = Column(String(20), default="queued")
+    attempts = Column(Integer, default=0)
+    maxAttempts = Column(Integer, default=3)
+    runAt = Column(DateTime, server_default=func.now())
+    lockedUntil = Column(DateTime)
+    progress = Column(JSONB)
+    result = Column(JSONB)
+    error = Column(Text)
+    created = Column(DateTime, server_default=func.now())
+    finished = Column(DateTime)
@@ -1,9 +1,50 @@
 import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from io import BytesIO
 from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad, unpad
 from PIL import Image, ImageFilter, ImageFont, ImageDraw, ImageEnhance, ImageOps
 
 
+def encoder_settings() -> dict:
+    """Encoder settings, they drive most of the CPU cost of a transform.
+    Read when called so values loaded from .env apply"""
+    return {
+        "format": os.getenv("IMAGE_FORMAT", "PNG"),
+        "compress_level": int(os.getenv("IMAGE_COMPRESS_LEVEL", "6")),  # PNG, 0-9
+        "quality": int(os.getenv("IMAGE_QUALITY", "80")),  # WebP/JPEG
+    }
+
+
+def decode_limits() -> tuple[int, int]:
+    """(max side, max pixels): source images are decoded down to about
+    IMAGE_MAX_SIDE (longest side, px), and refused above IMAGE_MAX_PIXELS
+    before any pixel data is decoded. Read when called, like encoder_settings"""
+    return (
+        int(os.getenv("IMAGE_MAX_SIDE", "2000")),
+        int(os.getenv("IMAGE_MAX_PIXELS", "50000000")),
+    )
+
+
+class ImageTooLarge(ValueError):
+    """Source image over the byte or pixel limit"""
+
+
+@contextmanager
+def timed(timings: dict | None, step: str):
+    """Add the duration of the block to timings[step] (seconds), if given"""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = timings.get(step, 0.0) + time.perf_counter() - start
+
+
 class NFTImage:
     def __init__(self):
         self.fonts = {
@@ -14,11 +55,116 @@ class NFTImage:
         }
         self.lock_font = "bold"
         self.lock_img = "modules/nftimage/assets/lock.png"
+        # region Asset cache
+        # Lock image, loaded and resized once
+        lock_resize_factor = 0.3
+        with Image.open(self.lock_img) as lock_img:
+            self._lock = lock_img.convert("RGBA").resize(
+                (
+                    int(lock_img.width * lock_resize_factor),
+                    int(lock_img.height * lock_resize_factor),
+                )
+            )
+        self._fonts = {}  # {(font, size): FreeTypeFont}
+        # Prepared watermark layers, LRU bounded
+        self.overlay_cache_size = 32
+        self._overlays: OrderedDict[tuple, Image.Image] = OrderedDict()
+        # endregion
+        # Defaults of encode()
+        self.encoder = encoder_settings()
+        # Operations usable in transform(), see apply()
+        self.operations = {
+            "resize": self._resize,
+            "watermark": self._watermark,
+            "blur": self._blur,
+            "darken": self._darken,
+        }
 
-    def resize(self, image, size: tuple = (1000, 1000)):
+    # region Transform chain
+    def decode(
+        self, image: bytes, max_side: int = None, max_pixels: int = None
+    ) -> Image.Image:
+        """Open an image. With `max_side`, large images are decoded at a
+        reduced scale: JPEGs directly by libjpeg (draft, 1/2 to 1/8), other
+        formats with an integer box reduce. The result keeps at least
+        `max_side` px on its longest side"""
+        img = Image.open(BytesIO(image))
+        if max_pixels and img.width * img.height > max_pixels:
+            raise ImageTooLarge(
+                f"{img.width}x{img.height} image is over {max_pixels} pixels"
+            )
+        if max_side and max(img.size) > max_side:
+            img.draft(None, (max_side, max_side))  # No-op outside of JPEG
+            factor = max(img.size) // max_side
+            if factor > 1:
+                img = img.reduce(factor)
+        return img
+
+    def encode(
+        self,
+        image: Image.Image,
+        format: str = None,
+        compress_level: int = None,
+        quality: int = None,
+    ) -> bytes:
+        """Encode an image once, at the end of a chain.
+        compress_level applies to PNG, quality to WebP and JPEG"""
+        format = (format or self.encoder["format"]).upper()
+        options = {}
+        if format == "PNG":
+            options["compress_level"] = (
+                self.encoder["compress_level"]
+                if compress_level is None
+                else compress_level
+            )
+        elif format in ("WEBP", "JPEG"):
+            options["quality"] = (
+                self.encoder["quality"] if quality is None else quality
+            )
+            if format == "JPEG" and image.mode != "RGB":
+                image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, format=format, **options)
+        return output.getvalue()
+
+    def apply(
+        self, image: Image.Image, operations: list, timings: dict = None
+    ) -> Image.Image:
+        """Apply operations to a decoded image. Each operation is a name
+        ("blur") or a (name, kwargs) pair (("blur", {"radius": 10})).
+        Durations are added to `timings` by operation name, if given"""
+        for operation in operations:
+            if isinstance(operation, str):
+                name, kwargs = operation, {}
+            else:
+                name, kwargs = operation
+            with timed(timings, name):
+                image = self.operations[name](image, **kwargs)
+        return image
+
+    def transform(
+        self,
+        image: bytes,
+        operations: list,
+        format: str = None,
+        compress_level: int = None,
+        quality: int = None,
+    ) -> bytes:
+        """Decode once, apply all operations, encode once"""
+        return self.encode(
+            self.apply(self.decode(image), operations),
+            format=format,
+            compress_level=compress_level,
+            quality=quality,
+        )
+
+    # endregion
+
+    # region Operations
+    def _resize(self, image: Image.Image, size: tuple = (1000, 1000)) -> Image.Image:
         # If the image is not a square, add padding
         # Do not crop or stretch/compress the image
-        image = Image.open(BytesIO(image)).convert("RGBA")
+        image = image.convert("RGBA")
         w, h = image.size
         # Get the biggest dimension
         max_dim = max(w, h)
@@ -28,45 +174,40 @@ class NFTImage:
         outimg.paste(image, ((max_dim - w) // 2, (max_dim - h) // 2))
 
         # Resize the image by x and y
-        outimg = outimg.resize(size)
+        return outimg.resize(size)
 
-        img_bytes = BytesIO()
-        outimg.save(img_bytes, format="PNG")
-        return img_bytes.getvalue()
+    def _font(self, font_key: str, size: int) -> ImageFont.FreeTypeFont:
+        """Loaded TTF fonts, cached by (font, size)"""
+        key = (font_key, size)
+        if key not in self._fonts:
+            self._fonts[key] = ImageFont.truetype(self.fonts[font_key], size=size)
+        return self._fonts[key]
 
-    def watermark(
-        self,
-        image,
-        text: str = "Доступно только\nдля пользователей VK NFT",
-        font: ImageFont = None,
-        font_size: int = 20,
-    ):
-        if not font:
-            font = ImageFont.truetype(self.fonts[self.lock_font], size=font_size)
-        image = Image.open(BytesIO(image))
+    def _watermark_overlay(
+        self, size: tuple, text: str, font: ImageFont.FreeTypeFont
+    ) -> Image.Image:
+        """Transparent layer with the lock and the text for an image of `size`.
+        Cached by (font, font size, text, image size)"""
+        key = (font.path, font.size, text, size)
+        overlay = self._overlays.get(key)
+        if overlay is not None:
+            self._overlays.move_to_end(key)
+            return overlay
 
-        # Get lock image
-        lock_img = Image.open(self.lock_img)
-        # Resize lock image
-        lock_resize_factor = 0.3
-        lock_img = lock_img.resize(
-            (
-                int(lock_img.width * lock_resize_factor),
-                int(lock_img.height * lock_resize_factor),
-            )
-        )
+        lock_img = self._lock
         # Get width and height of lock image
         lock_w, lock_h = lock_img.size
         lock_offset = lock_h // 3
 
         # Get width and height of image
-        W, H = image.size
+        W, H = size
+        overlay = Image.new("RGBA", size, (0, 0, 0, 0))
         # Get width and height of text
-        draw = ImageDraw.Draw(image)
+        draw = ImageDraw.Draw(overlay)
         _, _, w, h = draw.textbbox((0, 0), text, font=font)
 
         # Paste lock image in the middle of the image
-        image.paste(lock_img, ((W - lock_w) // 2, (H - lock_h) // 2), lock_img)
+        overlay.alpha_composite(lock_img, ((W - lock_w) // 2, (H - lock_h) // 2))
 
         # Write text on image
         draw.text(
@@ -78,70 +219,165 @@ class NFTImage:
             fill="white",
         )
 
-        output = BytesIO()
-        image.save(output, format="PNG")
-        return output.getvalue()
+        self._overlays[key] = overlay
+        if len(self._overlays) > self.overlay_cache_size:
+            self._overlays.popitem(last=False)
+        return overlay
+
+    def _watermark(
+        self,
+        image: Image.Image,
+        text: str = "Доступно только\nдля пользователей VK NFT",
+        font: ImageFont = None,
+        font_size: int = 20,
+    ) -> Image.Image:
+        if not font:
+            font = self._font(self.lock_font, font_size)
+        overlay = self._watermark_overlay(image.size, text, font)
+        return Image.alpha_composite(image.convert("RGBA"), overlay)
+
+    def _blur(self, image: Image.Image, radius: int = 20) -> Image.Image:
+        return image.filter(ImageFilter.GaussianBlur(radius=radius))
+
+    def _darken(self, image: Image.Image, factor: int = 2) -> Image.Image:
+        """Make image darker"""
+        enhancer = ImageEnhance.Brightness(image)
+        return enhancer.enhance(1 / factor)
+
+    # endregion
+
+    # region Single operations (bytes in, bytes out)
+    def resize(self, image, size: tuple = (1000, 1000)):
+        return self.transform(image, [("resize", {"size": size})], format="PNG")
+
+    def watermark(
+        self,
+        image,
+        text: str = "Доступно только\nдля пользователей VK NFT",
+        font: ImageFont = None,
+        font_size: int = 20,
+    ):
+        return self.transform(
+            image,
+            [("watermark", {"text": text, "font": font, "font_size": font_size})],
+            format="PNG",
+        )
 
     def blur(self, image, radius: int = 20):
-        image = Image.open(BytesIO(image))
-        image = image.filter(ImageFilter.GaussianBlur(radius=radius))
-        output = BytesIO()
-        image.save(output, format="PNG")
-        return output.getvalue()
+        return self.transform(image, [("blur", {"radius": radius})], format="PNG")
 
     def darken(self, image, factor: int = 2):
         """Make image darker"""
-        image = Image.open(BytesIO(image))
-        enhancer = ImageEnhance.Brightness(image)
-        image = enhancer.enhance(0.5)
-        output = BytesIO()
-        image.save(output, format="PNG")
-        return output.getvalue()
+        return self.transform(image, [("darken", {"factor": factor})], format="PNG")
 
-    def encrypt(self, file: bytes, key: str):
-        file = BytesIO(file)
-        # 16-byte random initialization vector
-        iv = os.urandom(16)
+    # endregion
+
+    # region Encryption
+    # AES-128-CBC, output is IV + ciphertext with PKCS#7 padding.
+    # Streams are processed in chunk_size pieces (a multiple of the block size)
+    chunk_size = 1 << 20
+    block_size = AES.block_size
 
+    def _cipher(self, key: str, iv: bytes):
         # Pad the password to a multiple of 16 bytes
         key = key.ljust(16, "\0")
-
         # Create the AES cipher object with 128-bit key
-        cipher = AES.new(bytes(key, "utf-8"), AES.MODE_CBC, iv)
+        return AES.new(bytes(key, "utf-8"), AES.MODE_CBC, iv)
 
+    def encrypt(self, file, key: str) -> bytes:
+        """Encrypt a bytes-like object in one pass into a preallocated buffer"""
+        data = memoryview(file).cast("B")
+        # 16-byte random initialization vector
+        iv = os.urandom(16)
+        cipher = self._cipher(key, iv)
+
+        full = len(data) - len(data) % self.block_size
+        output = bytearray(16 + full + self.block_size)
+        out = memoryview(output)
         # Write the initialization vector to the output
-        output = iv
+        out[:16] = iv
+        if full:
+            cipher.encrypt(data[:full], output=out[16 : 16 + full])
+        cipher.encrypt(pad(bytes(data[full:]), self.block_size), output=out[16 + full :])
+        return bytes(output)
 
-        chunk_size = 16
-        while True:
-            # Use an alternative to read() that returns bytes
-            chunk = file.read(chunk_size)
-            if len(chunk) == 0:
-                break
-            elif len(chunk) % chunk_size != 0:
-                chunk += b"\0" * (chunk_size - len(chunk) % chunk_size)
-            encrypted_chunk = cipher.encrypt(chunk)
-            output += encrypted_chunk
-        return output
-
-    def decrypt(self, file, key: str):
-        file = BytesIO(file)
+    def decrypt(self, file, key: str) -> bytes:
+        """Decrypt the output of encrypt()"""
+        data = memoryview(file).cast("B")
+        if len(data) < 32 or len(data) % self.block_size:
+            raise ValueError("Invalid ciphertext length")
         # Read the initialization vector from the input
-        iv = file.read(16)
+        cipher = self._cipher(key, bytes(data[:16]))
+        output = bytearray(len(data) - 16)
+        cipher.decrypt(data[16:], output=output)
+        return bytes(memoryview(output)[: len(output) - self._padding(output)])
 
-        # Pad the password to a multiple of 16 bytes
-        key = key.ljust(16, "\0")
+    def encrypt_stream(self, src, dst, key: str) -> int:
+        """Encrypt file-like `src` into file-like `dst` chunk by chunk.
+        Returns the number of bytes written"""
+        iv = os.urandom(16)
+        cipher = self._cipher(key, iv)
+        dst.write(iv)
+        written = 16
 
-        # Create the AES cipher object with 128-bit key
-        cipher = AES.new(bytes(key, "utf-8"), AES.MODE_CBC, iv)
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        out = memoryview(bytearray(self.chunk_size))
+        carry = 0  # Bytes of an incomplete block left from the last read
+        while True:
+            read = src.readinto(view[carry:])
+            if not read:
+                break
+            total = carry + read
+            full = total - total % self.block_size
+            if full:
+                cipher.encrypt(view[:full], output=out[:full])
+                dst.write(out[:full])
+                written += full
+            carry = total - full
+            view[:carry] = view[full:total]
+        last = cipher.encrypt(pad(bytes(view[:carry]), self.block_size))
+        dst.write(last)
+        return written + len(last)
+
+    def decrypt_stream(self, src, dst, key: str) -> int:
+        """Decrypt file-like `src` (output of encrypt/encrypt_stream) into
+        file-like `dst`. Returns the number of bytes written"""
+        iv = src.read(16)
+        if len(iv) != 16:
+            raise ValueError("Invalid ciphertext length")
+        cipher = self._cipher(key, iv)
+        written = 0
 
-        # Read the encrypted data
-        chunk_size = 16
-        output = b""
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        out = memoryview(bytearray(self.chunk_size))
+        carry = 0
         while True:
-            chunk = file.read(chunk_size)
-            if len(chunk) == 0:
+            read = src.readinto(view[carry:])
+            if not read:
                 break
-            decrypted_chunk = cipher.decrypt(chunk)
-            output += decrypted_chunk
-        return output
+            total = carry + read
+            # Hold the last complete block back, it carries the padding
+            full = total - total % self.block_size - self.block_size
+            if full > 0:
+                cipher.decrypt(view[:full], output=out[:full])
+                dst.write(out[:full])
+                written += full
+            else:
+                full = 0
+            carry = total - full
+            view[:carry] = view[full:total]
+        if carry != self.block_size:
+            raise ValueError("Invalid ciphertext length")
+        last = cipher.decrypt(bytes(view[:carry]))
+        last = last[: len(last) - self._padding(last)]
+        dst.write(last)
+        return written + len(last)
+
+    def _padding(self, plaintext) -> int:
+        """Length of the PKCS#7 padding at the end of `plaintext`"""
+        last_block = bytes(plaintext[-self.block_size :])
+        return self.block_size - len(unpad(last_block, self.block_size))
+
+    # endregion
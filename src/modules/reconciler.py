@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+from datetime import datetime, timedelta
+from os import getenv
+
+from modules import contracts
+from modules.db import AsyncDBManager
+from modules.models import Mint
+
+# Final Quiknode statuses that will never turn into "success"
+FAILED_STATUSES = {"failed", "failure", "error", "cancelled"}
+
+
+class MintReconciler:
+    """Single async loop that settles every pending mint.
+    Pending mints live in the `mints` table (so they survive a restart), are
+    checked with batched cm_getNFTMintStatus calls, back off exponentially
+    while still pending and are written back in bulk. Reservations left
+    "minting" by a lost cm_mintNFT call are failed after a timeout"""
+
+    def __init__(self, log, adb: AsyncDBManager):
+        self.log = log
+        self.adb = adb
+        self.batch_size = int(getenv("RECONCILER_BATCH_SIZE", "20"))
+        self.concurrency = int(getenv("RECONCILER_CONCURRENCY", "4"))
+        self.min_interval = float(getenv("RECONCILER_MIN_INTERVAL", "5"))
+        self.max_interval = float(getenv("RECONCILER_MAX_INTERVAL", "120"))
+        self.max_attempts = int(getenv("RECONCILER_MAX_ATTEMPTS", "200"))
+        # Seconds after which a mint still waiting for cm_mintNFT is failed
+        self.reservation_timeout = float(getenv("MINT_RESERVATION_TIMEOUT", "600"))
+        self._next_expiry = 0.0  # monotonic time of the next expiry sweep
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.on_success = []  # callbacks(db_mint), e.g. cache invalidation
+
+    # region Lifecycle
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # endregion
+
+    def wake(self) -> None:
+        """New mints were requested, check the queue now"""
+        self._wakeup.set()
+
+    def _interval(self, attempts: int) -> float:
+        """Adaptive delay: min_interval doubling per attempt, capped at max_interval"""
+        return min(self.min_interval * 2 ** min(attempts, 16), self.max_interval)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # Own schedule, so a constantly busy queue still expires
+                await self.expire_reservations()
+                claimed = await self.reconcile_once()
+                if claimed:
+                    # There may be more due mints, go again right away
+                    continue
+                async with self.adb.sessionmaker() as session:
+                    next_check = await self.adb.next_mint_check(session)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Mint reconciler iteration failed")
+                next_check = None
+            if next_check is None:
+                delay = self.max_interval
+            else:
+                delay = (next_check - datetime.utcnow()).total_seconds()
+                delay = min(max(delay, 0.5), self.max_interval)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def expire_reservations(self) -> None:
+        """Fail unanswered reservations, at most once per min_interval"""
+        if time.monotonic() < self._next_expiry:
+            return
+        self._next_expiry = time.monotonic() + self.min_interval
+        async with self.adb.sessionmaker() as session:
+            expired = await self.adb.expire_reservations(
+                session, self.reservation_timeout
+            )
+        if expired:
+            self.log.warning(f"{expired} unanswered mint reservations failed")
+
+    async def reconcile_once(self) -> int:
+        """Check all due mints once, returns the number of mints checked"""
+        async with self.adb.sessionmaker() as session:
+            mints = await self.adb.claim_due_mints(
+                session,
+                limit=self.batch_size * self.concurrency,
+                lease=self.max_interval,
+            )
+        if not mints:
+            return 0
+        batches = [
+            mints[i : i + self.batch_size]
+            for i in range(0, len(mints), self.batch_size)
+        ]
+        results = await asyncio.gather(*(self._check(batch) for batch in batches))
+
+        now = datetime.utcnow()
+        checks = []
+        hashes = {}
+        settled = []
+        for batch, responses in zip(batches, results):
+            for db_mint, response in zip(batch, responses):
+                status, mint_hash = self._parse(response)
+                attempts = db_mint.attempts + 1
+                if status == "pending" and attempts >= self.max_attempts:
+                    status = "failed"
+                if status == "success":
+                    hashes[db_mint.nftId] = mint_hash
+                    settled.append(db_mint)
+                elif status == "failed":
+                    self.log.warning(
+                        f"Mint {db_mint.mintId} of NFT {db_mint.nftId} failed: {response}"
+                    )
+                checks.append(
+                    {
+                        "b_id": db_mint.id,
+                        "b_status": status,
+                        "b_hash": mint_hash,
+                        "b_attempts": attempts,
+                        "b_next": now + timedelta(seconds=self._interval(attempts)),
+                    }
+                )
+
+        async with self.adb.sessionmaker() as session:
+            await self.adb.save_mint_checks(session, checks)
+            await self.adb.update_mints(session, hashes)
+        for db_mint in settled:
+            db_mint.status = "success"
+            for callback in self.on_success:
+                callback(db_mint)
+        return len(mints)
+
+    async def _check(self, batch: list[Mint]) -> list[dict]:
+        """One batched status request, at most `concurrency` of them in flight"""
+        async with self._semaphore:
+            try:
+                return await contracts.check_minting_statuses(
+                    [(db_mint.mintId, db_mint.collectionID) for db_mint in batch]
+                )
+            except Exception as e:
+                self.log.error(f"Mint status batch failed: {e!r}")
+                return [{"error": repr(e)} for _ in batch]
+
+    @staticmethod
+    def _parse(response: dict) -> tuple[str, str]:
+        """(pending|success|failed, mintHash) from a cm_getNFTMintStatus result"""
+        if not isinstance(response, dict) or "error" in response:
+            return "pending", ""
+        on_chain = response.get("onChain") or {}
+        status = str(on_chain.get("status", "pending")).lower()
+        if status == "success":
+            return "success", on_chain.get("mintHash") or ""
+        if status in FAILED_STATUSES:
+            return "failed", ""
+        return "pending", ""
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+from modules.auth.model import TicketCreateSchema, TicketResponseSchema
+from modules.db import AsyncDBManager
+from modules.imagepipeline import ImagePipeline
+from modules.jobqueue import JobQueue
+from modules.minter import Minter
+
+
+async def process_ticket(
+    adb: AsyncDBManager, pipeline: ImagePipeline, ticket: TicketCreateSchema
+) -> dict:
+    """Run the image pipeline for a ticket and store it"""
+    mint_img, blur_img = await pipeline.process(ticket.image)
+    async with adb.sessionmaker() as session:
+        tk = await adb.create_nft(session, ticket, mint_img, blur_img)
+    return TicketResponseSchema.from_orm(tk).dict()
+
+
+def register_tasks(
+    queue: JobQueue, adb: AsyncDBManager, pipeline: ImagePipeline, minter: Minter
+) -> None:
+    """Handlers of the job types the API enqueues"""
+
+    async def create_ticket(payload: dict, progress: dict) -> dict:
+        return await process_ticket(adb, pipeline, TicketCreateSchema(**payload))
+
+    async def mint(payload: dict, progress: dict) -> dict:
+        results = await minter.mint(payload["nft_id"], [payload["vk_id"]], progress)
+        return results[0]
+
+    async def bulk_mint(payload: dict, progress: dict) -> list[dict]:
+        return await minter.mint(payload["nft_id"], payload.get("recipients"), progress)
+
+    queue.register("create_ticket", create_ticket, concurrency=4)
+    queue.register("mint", mint, concurrency=4)
+    queue.register("bulk_mint", bulk_mint, concurrency=1)
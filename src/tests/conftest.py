@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""Run from src/: python -m pytest -q tests"""
+import pytest
+
+from benchmarks import stubs
+from benchmarks.stubs import PictshareHandler, QuiknodeHandler
+
+
+@pytest.fixture
+def quiknode():
+    """Stub Quiknode server, its handler class exposes failures and calls"""
+    server = stubs.serve(QuiknodeHandler)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def pictshare():
+    server = stubs.serve(PictshareHandler)
+    yield server
+    server.shutdown()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import asyncio
+import socket
+
+import httpx
+import pytest
+
+from modules import contracts
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setenv("QUIKNODE_RETRIES", "2")
+    monkeypatch.setenv("QUIKNODE_BACKOFF", "0")
+    contracts._settings = None
+    contracts._client = None
+    yield
+    contracts._settings = None
+    contracts._client = None
+
+
+def use(monkeypatch, url: str) -> None:
+    monkeypatch.setenv("QUIKNODE_URL", url)
+
+
+def url_of(server) -> str:
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def run(coro):
+    async def with_client():
+        try:
+            return await coro
+        finally:
+            await contracts.close()
+
+    return asyncio.run(with_client())
+
+
+def closed_port_url() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}/"
+
+
+def mint():
+    return contracts.mint_nft("collection", "name", "description", "img", "wallet", {})
+
+
+def test_idempotent_call_retries_on_error_status(monkeypatch, quiknode):
+    use(monkeypatch, url_of(quiknode))
+    quiknode.RequestHandlerClass.failures.extend([503, 502])
+    result = run(contracts.get_all_nfts("wallet"))
+    assert result["owner"] == "wallet"
+    assert quiknode.RequestHandlerClass.calls == 3
+
+
+def test_idempotent_call_gives_up_after_retries(monkeypatch, quiknode):
+    use(monkeypatch, url_of(quiknode))
+    quiknode.RequestHandlerClass.failures.extend([503, 503, 503])
+    with pytest.raises(httpx.HTTPStatusError):
+        run(contracts.get_all_nfts("wallet"))
+    assert quiknode.RequestHandlerClass.calls == 3
+
+
+def test_mint_is_not_retried_once_the_request_was_sent(monkeypatch, quiknode):
+    use(monkeypatch, url_of(quiknode))
+    quiknode.RequestHandlerClass.failures.append(503)
+    with pytest.raises(httpx.HTTPStatusError):
+        run(mint())
+    assert quiknode.RequestHandlerClass.calls == 1
+
+
+def test_mint_is_retried_on_connect_error(monkeypatch):
+    use(monkeypatch, closed_port_url())
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(contracts.asyncio, "sleep", sleep)
+    with pytest.raises(httpx.ConnectError):
+        run(mint())
+    assert len(delays) == 2
+
+
+def test_missing_url_fails(monkeypatch):
+    monkeypatch.delenv("QUIKNODE_URL", raising=False)
+    with pytest.raises(RuntimeError):
+        contracts.settings()
+
+
+def test_batch_results_follow_call_order(monkeypatch, quiknode):
+    use(monkeypatch, url_of(quiknode))
+    quiknode.RequestHandlerClass.reverse_batches = True
+    results = run(
+        contracts.batch(
+            [
+                ("qn_fetchNFTs", ["first"]),
+                ("no_such_method", []),
+                ("qn_fetchNFTs", ["third"]),
+            ]
+        )
+    )
+    assert results[0]["owner"] == "first"
+    assert "error" in results[1]
+    assert results[2]["owner"] == "third"
+    assert quiknode.RequestHandlerClass.calls == 1
+
+
+def test_empty_batch_sends_nothing(monkeypatch, quiknode):
+    use(monkeypatch, url_of(quiknode))
+    assert run(contracts.batch([])) == []
+    assert quiknode.RequestHandlerClass.calls == 0
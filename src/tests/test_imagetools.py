@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import asyncio
+import io
+
+import httpx
+import pytest
+
+from benchmarks.stubs import link
+from modules.imagetools import ImageTools
+
+
+@pytest.fixture
+def itools(monkeypatch, pictshare):
+    monkeypatch.setenv("PICTSHARE_RETRIES", "2")
+    monkeypatch.setenv("PICTSHARE_BACKOFF", "0")
+    return ImageTools(f"http://127.0.0.1:{pictshare.server_port}")
+
+
+def run(itools: ImageTools, coro):
+    async def with_client():
+        try:
+            return await coro
+        finally:
+            await itools.aclose()
+
+    return asyncio.run(with_client())
+
+
+def test_upload_retries_on_error_status(itools, pictshare):
+    pictshare.RequestHandlerClass.failures.extend([503, 429])
+    assert run(itools, itools.upload_async(b"image")) == link(b"image")
+    assert pictshare.RequestHandlerClass.calls == 3
+
+
+def test_upload_gives_up_after_retries(itools, pictshare):
+    pictshare.RequestHandlerClass.failures.extend([503, 503, 503])
+    with pytest.raises(httpx.HTTPStatusError):
+        run(itools, itools.upload_async(b"image"))
+    assert pictshare.RequestHandlerClass.calls == 3
+
+
+def test_upload_does_not_retry_client_errors(itools, pictshare):
+    pictshare.RequestHandlerClass.failures.append(400)
+    with pytest.raises(httpx.HTTPStatusError):
+        run(itools, itools.upload_async(b"image"))
+    assert pictshare.RequestHandlerClass.calls == 1
+
+
+def test_retried_file_upload_is_sent_from_the_start(itools, pictshare):
+    pictshare.RequestHandlerClass.failures.append(503)
+    image = b"image" * 1000
+    file = io.BytesIO(image)
+    assert run(itools, itools.upload_async(file, "image.png")) == link(image)
+    assert pictshare.RequestHandlerClass.calls == 2
+
+
+def test_upload_from_path(itools, pictshare, tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"image")
+    assert run(itools, itools.upload_async(str(path))) == link(b"image")
+
+
+def test_upload_many_keeps_order(itools, pictshare):
+    # Random latency, so the uploads finish in a different order
+    pictshare.RequestHandlerClass.latency = 0.05
+    images = [bytes([i]) * 100 for i in range(8)]
+    assert run(itools, itools.upload_many(images)) == [link(i) for i in images]
+    assert pictshare.RequestHandlerClass.calls == 8
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Background worker: runs the durable job queue and the mint reconciler,
+so they can be scaled apart from the API (start the API with
+API_RUN_WORKER=false then)"""
+import asyncio
+import logging
+import signal
+from os import getenv
+
+from dotenv import load_dotenv
+
+# Before the modules, some of them read their settings on import
+DOCKER_MODE = getenv("DOCKER_MODE") == "true"
+if not DOCKER_MODE:
+    load_dotenv()
+
+from modules import contracts
+from modules.db import DBManager, AsyncDBManager
+from modules.imagepipeline import ImagePipeline
+from modules.imagetools import ImageTools
+from modules.jobqueue import JobQueue
+from modules.logs import setup_logging
+from modules.minter import Minter
+from modules.reconciler import MintReconciler
+from modules.tasks import register_tasks
+
+# region Logging
+log = logging.getLogger("worker")
+
+if DOCKER_MODE:
+    logfile_path = r"/data/worker.log"
+else:
+    logfile_path = r"worker.log"
+log_listener = setup_logging(log, logfile_path, getenv("LOGGING_LEVEL", "info"))
+# endregion
+
+
+async def main() -> None:
+    contracts.settings()  # Fails fast when QUIKNODE_URL is missing
+    itools = ImageTools(getenv("PICTSHARE_URL"))
+    pipeline = ImagePipeline(log, itools)
+    # Creates the schema and applies migrations, like the API does
+    await asyncio.to_thread(DBManager, log, itools)
+    adb = AsyncDBManager(log)
+    reconciler = MintReconciler(log, adb)
+    # Drops the API's cached listing of the wallet (see api.py)
+    reconciler.on_success.append(lambda db_mint: adb.invalidate("wallet", db_mint.wallet))
+    minter = Minter(log, adb, reconciler)
+    job_queue = JobQueue(log, adb)
+    register_tasks(job_queue, adb, pipeline, minter)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    reconciler.start()
+    job_queue.start()
+    log.warning(f"Worker started: {', '.join(job_queue.handlers)} jobs")
+    await stopping.wait()
+    log.warning("Worker stopping")
+    await job_queue.stop()
+    await reconciler.stop()
+    await pipeline.close()
+    await adb.close()
+    await contracts.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()